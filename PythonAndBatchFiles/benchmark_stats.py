@@ -0,0 +1,190 @@
+#-------------------------------------------------------------
+# Name:       ArcGIS Stats benchmark
+# Purpose:    Runs generate_stats.py end to end against the replay server with a fixed number of log messages, and reports
+#             the wall time, peak memory and number of requests made, so changes to the extraction pipeline can be compared.
+#             Each run is made in a separate process so the peak memory of one run does not carry over to the next.
+#             Can also time how long generate_stats.py takes from starting to making its first request, with and without arcpy.
+# Author:     Keith Miller (keith.miller@kapiticoast.govt.nz)
+# Date Created:    18/10/2026
+# Copyright:   (c) Kapiti Coast District Council, Eagle Technologies
+# ArcGIS Version:   10.0+
+# Python Version:   2.7
+#--------------------------------
+
+# Import modules
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import replay_server
+
+# Set global variables
+defaultMessageCounts = [10000, 100000, 1000000] # Number of log messages to benchmark with, if none are given on the command line
+shortTimePeriod = "5" # Time periods passed to generate_stats.py, in minutes
+midTimePeriod = "30"
+longTimePeriod = "720"
+startupRuns = 5 # Number of times generate_stats.py is started when timing startup, the fastest of which is reported
+
+
+# A function that returns the peak memory used by this process, in megabytes
+def peakMemoryMB():
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on Mac and kilobytes on Linux
+        return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+    except ImportError:
+        # Windows
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        getProcessMemoryInfo = ctypes.windll.psapi.GetProcessMemoryInfo
+        getProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+        getProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / (1024.0 * 1024.0)
+
+
+# A function that runs generate_stats.py once against the replay server and prints the wall time, CPU time and peak memory as JSON
+def runStats(baseURL, serverPort, workFolder):
+
+    import generate_stats
+
+    # Keep the state and log files for the run out of the script folder
+    generate_stats.useCheckpoint = "true"
+    generate_stats.stateFolder = workFolder
+    generate_stats.sendErrorEmail = "false"
+    generate_stats.logger, generate_stats.logMessage = generate_stats.setLogging(os.path.join(workFolder, "Benchmark.log"))
+
+    featureServiceURL = baseURL + "/arcgis/rest/services/Stats/FeatureServer/"
+    startTime = time.time()
+    startCPUTime = sum(os.times()[:2])
+    generate_stats.mainFunction("Benchmark.log",
+                                shortTimePeriod,
+                                midTimePeriod,
+                                longTimePeriod,
+                                "admin",
+                                "password",
+                                "127.0.0.1",
+                                serverPort,
+                                "DOMAIN\\user",
+                                "password",
+                                baseURL + "/arcgis/sharing/rest/generateToken",
+                                *[featureServiceURL + str(layer) for layer in range(7)])
+    wallTime = time.time() - startTime
+    cpuTime = sum(os.times()[:2]) - startCPUTime
+
+    print(json.dumps({"wallTime": wallTime, "cpuTime": cpuTime, "peakMemoryMB": peakMemoryMB()}))
+
+
+# A function that benchmarks generate_stats.py with a number of synthetic log messages
+def benchmark(noOfMessages):
+
+    # Finish the logs a minute before the current minute, so they all fall inside the time period the run fetches
+    logs = replay_server.SyntheticLogs(noOfMessages, replay_server.currentMinuteUTC() - (60 * 1000))
+    server = replay_server.ReplayServer(logs).start()
+    workFolder = tempfile.mkdtemp()
+
+    try:
+        # Checkpoint at the oldest message so the run fetches all of them, whatever the short time period
+        with open(os.path.join(workFolder, "Benchmark.json"), "w") as f:
+            json.dump({"checkpoint": {"lastLogTimeUTC": logs.oldestTimeUTC, "boundaryHashes": []}}, f)
+
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run", server.baseURL(), str(server.server_address[1]), workFolder])
+        if not isinstance(output, str):
+            output = output.decode("utf-8")
+        result = json.loads(output.strip().splitlines()[-1])
+        result["requests"] = dict(server.requestCounts)
+        result["featuresAdded"] = sum(server.featuresAdded.values())
+        return result
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workFolder, ignore_errors=True)
+
+
+# A function that times how long generate_stats.py takes from starting to making its first request, run as the batch files run it.
+# If importArcpy is true, arcpy is imported before the script starts, as it was before arcpy was only loaded for geoprocessing tools.
+def benchmarkStartup(importArcpy):
+
+    logs = replay_server.SyntheticLogs(1000, replay_server.currentMinuteUTC() - (60 * 1000))
+    server = replay_server.ReplayServer(logs).start()
+    workFolder = tempfile.mkdtemp()
+
+    try:
+        # Run a copy of the script so its log and state files are kept out of the script folder
+        script = os.path.join(workFolder, "generate_stats.py")
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_stats.py"), script)
+        os.mkdir(os.path.join(workFolder, "Logs"))
+
+        featureServiceURL = server.baseURL() + "/arcgis/rest/services/Stats/FeatureServer/"
+        arguments = ["Benchmark.log", shortTimePeriod, midTimePeriod, longTimePeriod, "admin", "password", "127.0.0.1", str(server.server_address[1]),
+                     "DOMAIN\\user", "password", server.baseURL() + "/arcgis/sharing/rest/generateToken"] + [featureServiceURL + str(layer) for layer in range(7)]
+        if importArcpy:
+            command = [sys.executable, "-c", "import sys, runpy, arcpy; sys.argv = sys.argv[1:]; runpy.run_path(sys.argv[0], run_name='__main__')", script] + arguments
+        else:
+            command = [sys.executable, script] + arguments
+
+        firstRequestTimes = []
+        runTimes = []
+        for run in range(startupRuns):
+            server.resetCounts()
+            startTime = time.time()
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call(command, stdout=devnull)
+            runTimes.append(time.time() - startTime)
+            firstRequestTimes.append(server.firstRequestTime - startTime)
+
+        return min(firstRequestTimes), min(runTimes)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workFolder, ignore_errors=True)
+
+
+# This test allows the script to be run from the command prompt:
+#   python benchmark_stats.py [number of log messages ...]
+#   python benchmark_stats.py --startup
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":
+        runStats(sys.argv[2], sys.argv[3], sys.argv[4])
+        sys.exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--startup":
+        print("%-28s %20s %16s" % ("Startup", "First request(s)", "Whole run(s)"))
+        for label, importArcpy in [("arcpy imported at startup", True), ("arcpy not imported", False)]:
+            firstRequestTime, runTime = benchmarkStartup(importArcpy)
+            print("%-28s %20.2f %16.2f" % (label, firstRequestTime, runTime))
+        sys.exit()
+
+    messageCounts = [int(count) for count in sys.argv[1:]] or defaultMessageCounts
+
+    print("%12s %12s %12s %12s %12s %12s  %s" % ("Messages", "Wall time(s)", "CPU time(s)", "Messages/s", "Peak MB", "Requests", "Requests by endpoint"))
+    for noOfMessages in messageCounts:
+        result = benchmark(noOfMessages)
+        print("%12d %12.2f %12.2f %12.0f %12.1f %12d  %s" % (noOfMessages,
+                                                             result["wallTime"],
+                                                             result["cpuTime"],
+                                                             noOfMessages / max(result["wallTime"], 0.001),
+                                                             result["peakMemoryMB"],
+                                                             sum(result["requests"].values()),
+                                                             ", ".join(endpoint + ": " + str(count) for endpoint, count in sorted(result["requests"].items()))))
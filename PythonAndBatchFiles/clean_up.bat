@@ -9,6 +9,8 @@ REM    E ArcGIS Portal username (for Windows single sign on it will in the forma
 REM    F ArcGIS Portal password
 REM    G ArcGIS generate token URL (e.g. https://ppintgis.yourdomain.com/arcgis/sharing/rest/generateToken)
 REM    Multiple URLs for Feature Classes which are to have their stats trimmed
+REM    Optional - URLs for the IntGIS and then PublicGIS roll-up Feature Classes (stats per time period, services requested, layers drawn
+REM    and average layer draw time), which the stats are rolled up into by hour and day before they are trimmed
 C:\Python27\ArcGIS10.7\python "C:\Scripts\ArcGIS_Stats\clean_up.py" ^
     "clean_up.log" ^
     "30" ^
@@ -33,3 +35,11 @@ C:\Python27\ArcGIS10.7\python "C:\Scripts\ArcGIS_Stats\clean_up.py" ^
     "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/6" ^
     "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/7" ^
     "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/8" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsIntGIS/FeatureServer/9" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsIntGIS/FeatureServer/10" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsIntGIS/FeatureServer/11" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsIntGIS/FeatureServer/12" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/9" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/10" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/11" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/12" ^
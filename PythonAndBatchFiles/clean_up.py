@@ -1,6 +1,6 @@
 #-------------------------------------------------------------
 # Name:       ArcGIS Stats clean up
-# Purpose:    Removes any stats data which is more than 30 days old
+# Purpose:    Removes any stats data which is more than 30 days old, after rolling it up into hourly and daily stats
 # Author:     Keith Miller (keith.miller@kapiticoast.govt.nz)
 # Date Created:    07/02/2020
 # Copyright:   (c) Kapiti Coast District Council, Eagle Technologies
@@ -13,19 +13,23 @@ import os
 import sys
 import logging
 import smtplib
-import arcpy
 import datetime
 import requests
 import httplib
 import urllib
 import json
-from requests_ntlm import HttpNtlmAuth
 import time
 from calendar import timegm
 from collections import Counter
+from multiprocessing.pool import ThreadPool
+from stats_common import PortalSession, runningAsTool, loadArcpy
 
-# Enable data to be overwritten
-arcpy.env.overwriteOutput = True
+# arcpy is only imported when running as a geoprocessing tool (see loadArcpy), as importing it is slow and checks out a licence
+arcpy = None
+
+# Stands in for arcpy.ExecuteError until arcpy is imported, so the error handling in the main function works either way
+class ArcpyExecuteError(Exception):
+    pass
 
 # Set global variables
 
@@ -48,6 +52,15 @@ requestProtocol = "http" # http or https
 proxyURL = ""
 output = None
 
+# Purging
+purgeThreads = 4 # Most feature layers purged at the same time
+purgeChunkSize = 1000 # Most features removed by each delete request, so deleting a large number of old stats does not time out or lock the table for long
+requestTimeout = 300 # Seconds to wait for each request to the portal
+
+# Roll-ups
+rollupPeriods = [("Hour", 60 * 60 * 1000), ("Day", 24 * 60 * 60 * 1000)] # Periods the 5 minute stats are rolled up into before they are purged, and their length in milliseconds
+daysHourlyRollupsToKeep = "365" # Days hourly roll-ups are kept for. Daily roll-ups are kept until removed by hand.
+
 def log(message):
     if loggingEnabled:
         logger.info(message)
@@ -75,7 +88,15 @@ def mainFunction(logFilename,
                  fcPublicGISAvgLayerDrawTimeURL,
                  fcPublicGISServicesRequestedByUserURL,
                  fcPublicGISStatsServicesStatus,
-                 fcPublicGISStatsServicesDown):
+                 fcPublicGISStatsServicesDown,
+                 fcIntGISStatsPerTimePeriodRollupURL="",
+                 fcIntGISServicesRequestedRollupURL="",
+                 fcIntGISLayersDrawnRollupURL="",
+                 fcIntGISAvgLayerDrawTimeRollupURL="",
+                 fcPublicGISStatsPerTimePeriodRollupURL="",
+                 fcPublicGISServicesRequestedRollupURL="",
+                 fcPublicGISLayersDrawnRollupURL="",
+                 fcPublicGISAvgLayerDrawTimeRollupURL=""):
 
     # --------------------------------------- Start of code --------------------------------------- #
 
@@ -84,46 +105,50 @@ def mainFunction(logFilename,
         ### Remove old stats ###
         ########################
         
-        # Generate portal token
-        r = requests.post(tokenURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data = {"f": "json"})
-        token = r.json()['token']
-
-        # Loop through feature services
-        featureServices = argv[5:]
-        for featureService in featureServices:
-
-            # Set up URLs and 'where' clause
-            whereClause = "StatDateUTC < CURRENT_TIMESTAMP - " + daysStatsToKeep
-            queryURL = featureService + '/query'
-            deleteFeaturesURL = featureService + '/deleteFeatures'
-
-            # Find out how many records will be deleted
-            data = {
-                "f": "json",
-                "token": token,
-                "where": whereClause,
-                "returnCountOnly": "true"
-            }
-
-            # Post data
-            headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-            r = requests.post(url = queryURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
-
-            log(featureService)
-            log(r.text)
+        # Set up the session used for all requests to the portal, which generates the portal token
+        portalSession = PortalSession(tokenURL, domainUsername, domainPassword, requestTimeout=requestTimeout)
+
+        # Generate the token before the layers are purged at the same time, so it is only generated once
+        portalSession.getToken()
+
+        # Stats are kept for whole UTC days, so every hour and day rolled up before purging has all of its stats
+        whereClause = "StatDateUTC < " + startOfDayUTC(daysStatsToKeep)
+        featureServices = [fcIntGISStatsPerTimePeriodURL, fcIntGISErrorsURL, fcIntGISWarningsURL, fcIntGISServicesRequestedURL, fcIntGISLayersDrawnURL,
+                           fcIntGISAvgLayerDrawTimeURL, fcIntGISServicesRequestedByUserURL, fcIntGISStatsServicesStatus, fcIntGISStatsServicesDown,
+                           fcPublicGISStatsPerTimePeriodURL, fcPublicGISErrorsURL, fcPublicGISWarningsURL, fcPublicGISServicesRequestedURL, fcPublicGISLayersDrawnURL,
+                           fcPublicGISAvgLayerDrawTimeURL, fcPublicGISServicesRequestedByUserURL, fcPublicGISStatsServicesStatus, fcPublicGISStatsServicesDown]
+        purgeLayers = [(featureService, whereClause) for featureService in featureServices]
+
+        # Roll up the stats about to be purged for each site that has roll-up layers
+        rollupSites = [
+            ("IntGIS", [fcIntGISStatsPerTimePeriodURL, fcIntGISServicesRequestedURL, fcIntGISLayersDrawnURL, fcIntGISAvgLayerDrawTimeURL],
+                       [fcIntGISStatsPerTimePeriodRollupURL, fcIntGISServicesRequestedRollupURL, fcIntGISLayersDrawnRollupURL, fcIntGISAvgLayerDrawTimeRollupURL]),
+            ("PublicGIS", [fcPublicGISStatsPerTimePeriodURL, fcPublicGISServicesRequestedURL, fcPublicGISLayersDrawnURL, fcPublicGISAvgLayerDrawTimeURL],
+                          [fcPublicGISStatsPerTimePeriodRollupURL, fcPublicGISServicesRequestedRollupURL, fcPublicGISLayersDrawnRollupURL, fcPublicGISAvgLayerDrawTimeRollupURL])
+        ]
+        for siteName, sourceFeatureServices, rollupFeatureServices in rollupSites:
+            if not all(rollupFeatureServices):
+                continue
+
+            if rollUpStats(portalSession, sourceFeatureServices, rollupFeatureServices, whereClause):
+                # Remove the hourly roll-ups once they are old enough, keeping the daily ones
+                purgeLayers += [(featureService, "Period = 'Hour' AND StatDateUTC < " + startOfDayUTC(daysHourlyRollupsToKeep)) for featureService in rollupFeatureServices]
+            else:
+                # Keep the stats until they have been rolled up, so they are rolled up on the next run
+                log("The " + siteName + " stats could not be rolled up, so they will not be purged")
+                purgeLayers = [purge for purge in purgeLayers if purge[0] not in sourceFeatureServices]
 
-            # Delete the records
-            data = {
-                "f": "json",
-                "token": token,
-                "where": whereClause
-            }
+        # Purge a number of feature services at the same time
+        purgePool = ThreadPool(min(purgeThreads, max(len(purgeLayers), 1)))
+        purgeResults = purgePool.map(lambda purge: purgeLayer(portalSession, purge[0], purge[1]), purgeLayers)
+        purgePool.close()
 
-            # Post data
-            headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-            r = requests.post(url = deleteFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
+        # Show the number of features deleted from each feature service and how long it took
+        for featureService, featuresFound, featuresDeleted, seconds in purgeResults:
+            log(featureService + " - deleted " + str(featuresDeleted) + " of " + str(featuresFound) + " features in " + ("%.1f" % seconds) + " seconds")
+        log("Total features deleted: " + str(sum(result[2] for result in purgeResults)))
 
-            log(r.text)
+        log(portalSession.summary())
 
 
         # --------------------------------------- End of code --------------------------------------- #  
@@ -132,7 +157,7 @@ def mainFunction(logFilename,
         if __name__ == '__main__':
 
             # Return the output if there is any
-            if output:
+            if output and arcpy:
                 arcpy.SetParameterAsText(1, output)
 
         # Otherwise return the result          
@@ -154,11 +179,11 @@ def mainFunction(logFilename,
         pass
 
     # If arcpy error
-    except arcpy.ExecuteError:           
+    except ArcpyExecuteError:           
 
         # Build and show the error message
         errorMessage = arcpy.GetMessages(2)   
-        arcpy.AddError(errorMessage)           
+        addError(errorMessage)           
 
         # Logging
         if loggingEnabled:
@@ -197,7 +222,7 @@ def mainFunction(logFilename,
                 except Exception:
                     errorMessage = 'Unable to encode error message component'
 
-        arcpy.AddError(errorMessage)              
+        addError(errorMessage)              
 
         # Logging
         if loggingEnabled:
@@ -220,6 +245,231 @@ def mainFunction(logFilename,
 # End of main function
 
 
+# A function that returns a where clause timestamp for the start of the UTC day a number of days ago
+def startOfDayUTC(daysAgo):
+
+    return "timestamp '" + (datetime.datetime.utcnow() - datetime.timedelta(days=int(daysAgo))).strftime("%Y-%m-%d") + " 00:00:00'"
+
+
+# A function that rolls up the stats matching a where clause into hourly and daily rows, so they are kept after the 5 minute stats are purged.
+# The feature services are the stats per time period, services requested, layers drawn and average layer draw time layers for a site,
+# and the roll-up layers for each. Counts are summed, and average draw times are weighted by the number of layers drawn.
+# Hours and days already in a roll-up layer are not added again, so running again after the purge failed does not count the stats twice.
+# Returns whether all of the stats were rolled up.
+def rollUpStats(portalSession, sourceFeatureServices, rollupFeatureServices, whereClause):
+
+    try:
+        sourceFeatures = [queryFeatures(portalSession, featureService, whereClause) for featureService in sourceFeatureServices]
+        if None in sourceFeatures:
+            return False
+        perTimePeriodFeatures, servicesRequestedFeatures, layersDrawnFeatures, avgLayerDrawTimeFeatures = sourceFeatures
+        if not any(sourceFeatures):
+            return True
+
+        # Number of times each layer was drawn in each 5 minutes, to weight its average draw time by
+        layerDraws = dict(((feature["StatDateUTC"], feature["Layer"]), feature["ShortTimePeriod"] or 0) for feature in layersDrawnFeatures)
+
+        rollups = [[], [], [], []]
+        for period, periodLength in rollupPeriods:
+            for (periodStart, key), features in groupByPeriod(perTimePeriodFeatures, periodLength).items():
+                rollups[0].append({
+                    "StatDateUTC": periodStart,
+                    "Period": period,
+                    "ServicesRequested": sum(feature["ServicesRequested"] or 0 for feature in features),
+                    "MaxServicesRequested": max(feature["ServicesRequested"] or 0 for feature in features),
+                    "LayersDrawn": sum(feature["LayersDrawn"] or 0 for feature in features),
+                    "AvgLayerDrawTime": weightedAverage([(feature["AvgLayerDrawTime"], feature["LayersDrawn"]) for feature in features]),
+                    "MaxAvgLayerDrawTime": max(feature["AvgLayerDrawTime"] or 0 for feature in features),
+                    "Errors": sum(feature["Errors"] or 0 for feature in features),
+                    "Warnings": sum(feature["Warnings"] or 0 for feature in features),
+                    "Samples": len(features)
+                })
+
+            for (periodStart, service), features in groupByPeriod(servicesRequestedFeatures, periodLength, "Service").items():
+                rollups[1].append({
+                    "StatDateUTC": periodStart,
+                    "Period": period,
+                    "Service": service,
+                    "Requests": sum(feature["ShortTimePeriod"] or 0 for feature in features)
+                })
+
+            for (periodStart, layer), features in groupByPeriod(layersDrawnFeatures, periodLength, "Layer").items():
+                rollups[2].append({
+                    "StatDateUTC": periodStart,
+                    "Period": period,
+                    "Layer": layer,
+                    "Draws": sum(feature["ShortTimePeriod"] or 0 for feature in features)
+                })
+
+            for (periodStart, layer), features in groupByPeriod(avgLayerDrawTimeFeatures, periodLength, "Layer").items():
+                drawTimes = [(feature["ShortTimePeriod"], layerDraws.get((feature["StatDateUTC"], layer), 0)) for feature in features if feature["ShortTimePeriod"] is not None]
+                if not drawTimes:
+                    continue
+                rollups[3].append({
+                    "StatDateUTC": periodStart,
+                    "Period": period,
+                    "Layer": layer,
+                    "AvgDrawTime": weightedAverage(drawTimes),
+                    "MaxDrawTime": max(drawTime for drawTime, draws in drawTimes),
+                    "MaxP95DrawTime": max(feature.get("P95DrawTime") or 0 for feature in features),
+                    "Draws": sum(draws for drawTime, draws in drawTimes)
+                })
+
+        # Add the roll-ups to each roll-up layer, leaving out the hours and days it already has
+        firstPeriodStart = min(feature["StatDateUTC"] for features in sourceFeatures for feature in features)
+        firstPeriodStart -= firstPeriodStart % rollupPeriods[-1][1]
+        for featureService, features in zip(rollupFeatureServices, rollups):
+            existingFeatures = queryFeatures(portalSession, featureService, "StatDateUTC >= timestamp '" + time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(firstPeriodStart // 1000)) + "' AND " + whereClause, "StatDateUTC,Period")
+            if existingFeatures is None:
+                return False
+            existingPeriods = set((feature["Period"], feature["StatDateUTC"]) for feature in existingFeatures)
+            features = [feature for feature in features if (feature["Period"], feature["StatDateUTC"]) not in existingPeriods]
+
+            # Each hour or day is added in a single request that is rolled back if any of it fails, so a period found in the layer has been rolled
+            # up in full, and its stats can be purged. A request holds whole periods, up to purgeChunkSize features unless one period has more.
+            periodFeatures = {}
+            for feature in features:
+                periodFeatures.setdefault((feature["Period"], feature["StatDateUTC"]), []).append(feature)
+            chunks = []
+            for periodKey in sorted(periodFeatures):
+                if not chunks or (chunks[-1] and len(chunks[-1]) + len(periodFeatures[periodKey]) > purgeChunkSize):
+                    chunks.append([])
+                chunks[-1].extend(periodFeatures[periodKey])
+
+            featuresAdded = 0
+            for chunk in chunks:
+                # Set up the data to post
+                data = {
+                    "f": "json",
+                    "features": json.dumps([{"attributes": feature} for feature in chunk]),
+                    "rollbackOnFailure": "true"
+                }
+
+                # Post data
+                r = portalSession.post(featureService + '/addFeatures', data)
+                result = r.json()
+                if "error" in result or not all(addResult.get("success") for addResult in result.get("addResults", [])):
+                    log(featureService + " - " + r.text)
+                    return False
+                featuresAdded += len(result["addResults"])
+
+            log(featureService + " - added " + str(featuresAdded) + " roll-ups, " + str(len(existingFeatures)) + " already rolled up")
+
+    except Exception as e:
+        log("Error while rolling up stats: " + str(e))
+        return False
+
+    return True
+
+
+# A function that groups features into the hour or day they are in, and optionally the value of a field, e.g. the service.
+# Returns a dictionary of the features for each period start (in milliseconds) and field value.
+def groupByPeriod(features, periodLength, field=None):
+
+    groups = {}
+    for feature in features:
+        groups.setdefault((feature["StatDateUTC"] - feature["StatDateUTC"] % periodLength, feature.get(field)), []).append(feature)
+    return groups
+
+
+# A function that returns the average of a list of values and their weights, or the plain average if they have no weight
+def weightedAverage(valuesAndWeights):
+
+    valuesAndWeights = [(value or 0, weight or 0) for value, weight in valuesAndWeights]
+    totalWeight = sum(weight for value, weight in valuesAndWeights)
+    if totalWeight:
+        return float(sum(value * weight for value, weight in valuesAndWeights)) / totalWeight
+    if valuesAndWeights:
+        return float(sum(value for value, weight in valuesAndWeights)) / len(valuesAndWeights)
+    return 0
+
+
+# A function that returns the ids of the features matching a where clause in a feature service, or None if the query failed
+def queryObjectIds(portalSession, featureService, whereClause):
+
+    # Set up the data to post
+    data = {
+        "f": "json",
+        "where": whereClause,
+        "returnIdsOnly": "true"
+    }
+
+    # Post data
+    r = portalSession.post(featureService + '/query', data)
+    result = r.json()
+    if "error" in result:
+        log(featureService + " - " + r.text)
+        return None
+
+    return sorted(result.get("objectIds") or [])
+
+
+# A function that returns the attributes of the features matching a where clause in a feature service, or None if a query failed.
+# The features are fetched a chunk of ids at a time, so the number returned is not limited by the service's maximum record count.
+def queryFeatures(portalSession, featureService, whereClause, outFields="*"):
+
+    objectIds = queryObjectIds(portalSession, featureService, whereClause)
+    if objectIds is None:
+        return None
+
+    features = []
+    for chunkStart in range(0, len(objectIds), purgeChunkSize):
+        # Set up the data to post
+        data = {
+            "f": "json",
+            "objectIds": ",".join(str(objectId) for objectId in objectIds[chunkStart:chunkStart + purgeChunkSize]),
+            "outFields": outFields,
+            "returnGeometry": "false"
+        }
+
+        # Post data
+        r = portalSession.post(featureService + '/query', data)
+        result = r.json()
+        if "error" in result:
+            log(featureService + " - " + r.text)
+            return None
+        features += [feature["attributes"] for feature in result.get("features", [])]
+
+    return features
+
+
+# A function that deletes the features matching a where clause from a feature service, a chunk of features at a time.
+# Returns the feature service, the number of features found and deleted, and the seconds taken. Errors are logged rather than stopping the other layers being purged.
+def purgeLayer(portalSession, featureService, whereClause):
+
+    startTime = time.time()
+    featuresFound = 0
+    featuresDeleted = 0
+
+    try:
+        # Find the ids of the features to delete
+        objectIds = queryObjectIds(portalSession, featureService, whereClause)
+        if objectIds is None:
+            return featureService, featuresFound, featuresDeleted, time.time() - startTime
+        featuresFound = len(objectIds)
+
+        # Delete the features in chunks of ids
+        for chunkStart in range(0, len(objectIds), purgeChunkSize):
+            data = {
+                "f": "json",
+                "objectIds": ",".join(str(objectId) for objectId in objectIds[chunkStart:chunkStart + purgeChunkSize])
+            }
+
+            # Post data
+            r = portalSession.post(featureService + '/deleteFeatures', data)
+            result = r.json()
+            if "error" in result:
+                log(featureService + " - " + r.text)
+                break
+
+            featuresDeleted += len([deleteResult for deleteResult in result.get("deleteResults", []) if deleteResult.get("success")])
+
+    except Exception as e:
+        log(featureService + " - error while purging: " + str(e))
+
+    return featureService, featuresFound, featuresDeleted, time.time() - startTime
+
+
 def generateToken(username, password, portalUrl):
     '''Retrieves a token to be used with API requests.'''
     parameters = urllib.urlencode({'username' : username,
@@ -289,6 +539,20 @@ def assertJsonSuccess(data):
         
 
 
+# A function that shows a message in the geoprocessing tool, if running as one
+def addMessage(message):
+
+    if arcpy:
+        arcpy.AddMessage(message)
+
+
+# A function that shows an error in the geoprocessing tool, if running as one
+def addError(message):
+
+    if arcpy:
+        arcpy.AddError(message)
+
+
 # Start of set logging function
 def setLogging(logFile):
 
@@ -317,7 +581,7 @@ def setLogging(logFile):
 def sendEmail(message):
 
     # Send an email
-    arcpy.AddMessage("Sending email...")
+    addMessage("Sending email...")
 
     # Server and port information
     smtpServer = smtplib.SMTP(emailServerName, emailServerPort) 
@@ -345,8 +609,15 @@ def sendEmail(message):
 if __name__ == '__main__':
 
     # Arguments are optional - If running from ArcGIS Desktop tool, parameters will be loaded into *argv
-    argv = tuple(arcpy.GetParameterAsText(i)
-        for i in range(arcpy.GetArgumentCount()))
+    if runningAsTool():
+        loadArcpy(globals())
+
+        # Enable data to be overwritten
+        arcpy.env.overwriteOutput = True
+        argv = tuple(arcpy.GetParameterAsText(i)
+            for i in range(arcpy.GetArgumentCount()))
+    else:
+        argv = tuple(sys.argv[1:])
 
     logFilename = argv[0]
     logFile = os.path.join(os.path.dirname(__file__), "Logs", logFilename)
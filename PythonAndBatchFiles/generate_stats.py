@@ -5,7 +5,7 @@
 # Date Created:    10/01/2020
 # Copyright:   (c) Kapiti Coast District Council, Eagle Technologies
 # ArcGIS Version:   10.0+
-# Python Version:   2.7
+# Python Version:   2.7 / 3.6+
 #--------------------------------
 
 # Import modules
@@ -13,19 +13,45 @@ import os
 import sys
 import logging
 import smtplib
-import arcpy
 import datetime
-import requests
-import httplib
-import urllib
 import json
-from requests_ntlm import HttpNtlmAuth # This module is only needed when using Windows single sign on into ArcGIS Portal
+import codecs
+import math
+import re
+import hashlib
+import socket
+import errno
+import threading
+from multiprocessing.pool import ThreadPool
 import time
 from calendar import timegm
 from collections import Counter
-
-# Enable data to be overwritten
-arcpy.env.overwriteOutput = True
+from heapq import heappush, heappop
+from array import array
+from outbox import Outbox, flushOutbox
+from stats_common import PortalSession, tokenExpiring, tokenExpiryTime, recordStage, stageTimingsSummary, loadState, saveState, runningAsTool, loadArcpy
+
+try:
+    import httplib
+    import Queue
+    from urllib import urlencode
+except ImportError:
+    # Python 3, e.g. when run with generate_stats_2.py from run_all_stats.py
+    import http.client as httplib
+    import queue as Queue
+    from urllib.parse import urlencode
+
+try:
+    unicode
+except NameError:
+    unicode = str # Python 3
+
+# arcpy is only imported when running as a geoprocessing tool (see loadArcpy), as importing it is slow and checks out a licence
+arcpy = None
+
+# Stands in for arcpy.ExecuteError until arcpy is imported, so the error handling in the main function works either way
+class ArcpyExecuteError(Exception):
+    pass
 
 # Set global variables
 
@@ -48,6 +74,59 @@ requestProtocol = "http" # http or https
 proxyURL = ""
 output = None
 
+# ArcGIS Server admin API connections
+adminProtocol = "http" # http or https
+adminConnectionPoolSize = 4 # Maximum number of idle keep-alive connections held open to ArcGIS Server
+adminConnectionTimeout = 60 # Seconds to wait when connecting to or reading from ArcGIS Server
+
+# Log fetching
+logFetchSlices = 1 # Number of time slices the time period is split into and fetched at the same time (1 = fetch the whole time period in one go)
+
+# Checkpoint
+useCheckpoint = "true" # Fetch logs from the last message processed by the previous run, rather than for a fixed short time period
+checkpointMaxCatchUp = 1440 # Maximum number of minutes of logs fetched when catching up after a late or missed run
+stateFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "State") # Folder holding a state file for each log filename
+
+# Layer draw time percentiles
+drawTimeHistogramMinimum = 0.001 # Draw times (in seconds) at or below this go into the first bucket of each layer's draw time histogram
+drawTimeHistogramGrowth = 1.05 # Each histogram bucket is this much wider than the one before, so percentiles are accurate to within about 2.5%
+
+# Services requested by user
+topUserServiceRequests = 50 # Number of user/service pairs with the most requests posted each run. Requests for all other pairs are posted as one "Other" row
+userServiceRequestsCapacity = 1000 # Maximum number of user/service pairs counted at once, which keeps memory fixed however many distinct users there are
+
+# Publishing
+useApplyEdits = "true" # Write the layers of a feature service together with the service's applyEdits operation, rather than posting to each layer's addFeatures
+applyEditsMaxFeatures = 2000 # Maximum number of features sent in one applyEdits request. Larger edits are split over several requests
+outboxFlushSeconds = 120 # Most seconds spent sending the outbox to the portal each run. Features not sent by then wait in the outbox for the next run
+portalRequestTimeout = 60 # Seconds to wait when connecting to or reading from the portal
+
+# Dashboard summaries
+topSummaryCount = 10 # Number of services and layers in the top services and top layers summary layers for each period
+summaryHourMinutes = 60 # Minutes the "Hour" top services and layers are counted over
+
+# Error and warning grouping
+# Parts of a message that change between occurrences of the same problem, which are replaced so the occurrences share one fingerprint
+messageTemplatePatterns = [
+    (re.compile(r"\{?[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\}?"), "<GUID>"),
+    (re.compile(r"\b[0-9a-fA-F]{16,}\b"), "<ID>"), # Hex IDs, e.g. job and session IDs
+    (re.compile(r"-?\d+(\.\d+)?([eE][-+]?\d+)?"), "<N>"), # Numbers, including the coordinates of extents
+    (re.compile(r"<N>(\s*[,;]?\s*<N>)+"), "<N>") # Lists of numbers, e.g. extents and coordinates, so their length does not matter
+    ]
+
+# Log message classifiers
+logMessageClassifiers = [] # Functions that add log messages to the running totals, and the codes, messages and types they are for. Added with registerClassifier
+
+# Daemon
+runAsDaemon = "false" # Keep running and collect the stats every daemon interval, rather than being started by a scheduled task for each run
+daemonInterval = 5 # Minutes between runs when running as a daemon
+tokenExpiration = 60 # Minutes the admin and portal tokens are requested for
+tokenRefreshMargin = 5 # Tokens are generated again when they are this many minutes from expiring
+keepSessions = "false" # Keep sessions and tokens in warmSessions for later runs. Set when running as a daemon, and by run_all_stats.py to share them between sites
+warmSessions = {} # Admin connection pools, portal sessions and their tokens kept between runs when running as a daemon
+warmSessionsLock = threading.Lock()
+stageTimings = {} # Seconds taken by each stage of the last run for each log filename, e.g. for run_all_stats.py to report
+
 def log(message):
     if loggingEnabled:
         logger.info(message)
@@ -70,11 +149,18 @@ def mainFunction(logFilename,
                  fcServicesRequestedURL,
                  fcLayersDrawnURL,
                  fcAvgLayerDrawTimeURL,
-                 fcServicesRequestedByUserURL):
+                 fcServicesRequestedByUserURL,
+                 fcDailyTotalsURL="",
+                 fcTopServicesURL="",
+                 fcTopLayersURL=""):
 
     # --------------------------------------- Start of code --------------------------------------- #
 
     try:
+        # Time each stage of the run
+        stageTimings[logFilename] = []
+        stageStartTime = time.time()
+
         # Parameter conversions
         shortTimePeriod = int(shortTimePeriod)
         midTimePeriod = int(midTimePeriod)
@@ -89,240 +175,132 @@ def mainFunction(logFilename,
         timePeriod = shortTimePeriod * 60 * 1000 # In milliseconds
         periodEndUTC = (periodStartUTC - timePeriod) + 1 # add one millisecond so no overlap between time periods
 
+        # If the previous run left a checkpoint, fetch from the last message it processed up to now instead, so late or missed runs neither double count nor leave gaps
+        stateFile = os.path.join(stateFolder, os.path.splitext(logFilename)[0] + ".json")
+        state = loadState(stateFile)
+        outbox = Outbox(os.path.join(stateFolder, os.path.splitext(logFilename)[0] + "_outbox.db"))
+        checkpoint = outbox.loadCheckpoint() if useCheckpoint == "true" else None
+        if checkpoint:
+            maxCatchUpEndUTC = (periodStartUTC - (checkpointMaxCatchUp * 60 * 1000)) + 1
+            periodEndUTC = min(max(checkpoint["lastLogTimeUTC"], maxCatchUpEndUTC), periodStartUTC)
+            log('Fetching logs from checkpoint: ' + str(checkpoint["lastLogTimeUTC"]))
+
         ########################################################################
         ### Query logs to find number of layers accessed in last time period ###
         ########################################################################
 
-        # Set server security details
-        # Get a token
-        token = getToken(serverUsername, serverPassword, serverHostname, serverPort)
-        if token == "":
+        # Set up the keep-alive connections used for all ArcGIS Server admin requests in this run and get a token, or reuse them from the last run if running as a daemon
+        adminConnectionPool, token = getAdminSession(serverHostname, serverPort, serverUsername, serverPassword)
+        if not token:
             log("Could not generate a token with the username and password provided")
             return
-        
-        # Construct URL to query the logs
-        noOfLogMessagesPerPage = 10000
-        logQueryURL = "/arcgis/admin/logs/query"
-        logFilter = "{'services':'*','server':'*','machines':'*'}"
-        headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-
-        # Request logs from server. These come in batches of up to 10,000 messages at a time, so need to use loop to make sure we get all the messages.
-        receivedAllLogs = False
-        serverLogs = []
-        startTime = periodStartUTC
-        endTime = periodEndUTC
-
-        while not receivedAllLogs:
-
-            # Set parameters
-            log('startTime: ' + str(startTime))
-            log('endTime: ' + str(endTime))
-            params = urllib.urlencode({'level': 'FINE', 'startTime': startTime, 'endTime': endTime, 'filter':logFilter, 'token': token, 'pageSize': noOfLogMessagesPerPage, 'f': 'json'})
-
-            # Connect to URL and post parameters    
-            httpConn = httplib.HTTPConnection(serverHostname, serverPort)
-            httpConn.request("POST", logQueryURL, params, headers)
-
-            # Read response
-            response = httpConn.getresponse()
-            if (response.status != 200):
-                httpConn.close()
-                log("Error while querying logs")
-                return
-
-            data = response.read()
-            # log(data)
-
-            # Check that data returned is not an error object
-            if not assertJsonSuccess(data):
-                log("Error returned by operation " + data)
-                break
-
-            # Deserialize response into Python object
-            dataObj = json.loads(data)
-            httpConn.close()
+        stageStartTime = recordStage(stageTimings[logFilename], "Admin token", stageStartTime)
+
+        # Request logs from server. The time period can be split into slices which are fetched at the same time, each slice paging through its own logs.
+        timeSlices = splitTimePeriod(periodStartUTC, periodEndUTC, logFetchSlices)
+        if len(timeSlices) > 1:
+            log('Fetching logs in ' + str(len(timeSlices)) + ' time slices')
+            fetchPool = ThreadPool(len(timeSlices))
+            sliceStats = fetchPool.map(lambda timeSlice: fetchLogs(adminConnectionPool, token, timeSlice[0], timeSlice[1], statDateUTC, checkpoint), timeSlices)
+            fetchPool.close()
+        else:
+            sliceStats = [fetchLogs(adminConnectionPool, token, periodStartUTC, periodEndUTC, statDateUTC, checkpoint)]
 
-            serverLogs += dataObj["logMessages"]
+        if None in sliceStats:
+            # Not all of the logs could be fetched, so the checkpoint is left where it is and the whole period is fetched again next run.
+            # The token may have been invalidated, so generate a new one next time.
+            adminConnectionPool.tokenExpires = 0
+            return
 
-            if dataObj["hasMore"]:
+        # Merge the running totals from each time slice
+        logStats = sliceStats[0]
+        for otherStats in sliceStats[1:]:
+            mergeLogStats(logStats, otherStats)
 
-                # Find date of oldest log message retrieved
-                oldestLogDateUTC = dataObj["logMessages"][noOfLogMessagesPerPage -1]["time"]
-                startTime = oldestLogDateUTC - 1 # Subtract one millisecond so we don't get any repeated logs between the batches.
-            else:
-                log('Received all logs')
-                receivedAllLogs = True
+        log("Admin connections opened: " + str(adminConnectionPool.connectionsOpened) + ", reused: " + str(adminConnectionPool.connectionsReused))
+        if keepSessions != "true":
+            adminConnectionPool.close()
+        stageStartTime = recordStage(stageTimings[logFilename], "Fetch logs", stageStartTime)
 
         # Need these variables to calculate average draw time for an ExportMapImage call
-        layersDrawn = 0
-        totalDrawTime = 0
-        servicesRequested = 0
+        layersDrawn = logStats["layersDrawn"]
+        timedDraws = logStats["timedDraws"] # Draws whose log message has an elapsed time
+        totalDrawTime = logStats["totalDrawTime"]
+        servicesRequested = logStats["servicesRequested"]
         avgDrawTime = 0
-        errors = 0
-        warnings = 0
-        errorsDetails = []
-        warningsDetails = []
-        servicesDetails = []
-        layersDrawnDetails = []
-        layersDrawnTimeDetails = []
-
-        log('No of messages: ' + str(len(serverLogs)))
-
-        # Sort server logs by time (ascending)
-        serverLogs.sort(key=lambda k: k["time"]) 
-
-        # Iterate over logMessages
-        for item in serverLogs:
-
-            if item["code"] == 9029 and not item["message"].endswith('Stats/ArcGISStatsIntGIS/FeatureServer'): # 9029 == Service requested
-                servicesRequested += 1
-                servicePos = item["message"].find("Service: ")
-                serviceName = item["message"][servicePos + len("Service: "):]
-                servicesDetails.append(serviceName)
-
-            if item["message"] == "End ExportMapImage":
-                layersDrawn +=1
-                totalDrawTime += float(item["elapsed"])
-                layersDrawnDetails.append(item["source"])
-
-                foundLayer = False
-                for ld in layersDrawnTimeDetails:
-                    if ld["layer"] == item["source"]:
-                        foundLayer = True
-                        ld["totalLayerDrawTime"] += float(item["elapsed"])
-                        ld["layerCount"] += 1
-
-                if not foundLayer:
-                    layersDrawnTimeDetails.append({"layer": item["source"], "totalLayerDrawTime": float(item["elapsed"]), "layerCount": 1})
-
-            if item["type"] == "SEVERE":
-                errors += 1
-                errorsDetails.append({
-                    "attributes" : {
-                        "StatDateUTC": statDateUTC,
-                        "LogDateUTC": item["time"],
-                        "Message": item["message"],
-                        "Source": item["source"],
-                        "Code": item["code"],
-                        "GISUser": item["user"]}
-                    })
-
-
-            if item["type"] == "WARNING":
-                warnings += 1
-                warningsDetails.append({
-                    "attributes" : {
-                        "StatDateUTC": statDateUTC,
-                        "LogDateUTC": item["time"],
-                        "Message": item["message"],
-                        "Source": item["source"],
-                        "Code": item["code"],
-                        "GISUser": item["user"]}
-                    })
+        errors = logStats["errors"]
+        warnings = logStats["warnings"]
+        errorsDetails = messageGroupFeatures(logStats["errorGroups"], statDateUTC)
+        warningsDetails = messageGroupFeatures(logStats["warningGroups"], statDateUTC)
+        layersDrawnTimeDetails = logStats["layersDrawnTimeDetails"]
+
+        log('No of messages: ' + str(logStats["messages"]))
 
         log("Layers requested: " + str(servicesRequested))
         log("Total number of draws found in logs: " + str(layersDrawn))
-        log("Errors: " + str(errors))
-        log("Warnings: " + str(warnings))
+        log("Errors: " + str(errors) + " (" + str(len(errorsDetails)) + " distinct)")
+        log("Warnings: " + str(warnings) + " (" + str(len(warningsDetails)) + " distinct)")
 
-        if layersDrawn != 0:
-            avgDrawTime = 1.0 * (totalDrawTime / layersDrawn)
+        if timedDraws != 0:
+            avgDrawTime = 1.0 * (totalDrawTime / timedDraws)
             log("Average draw time: " + str(avgDrawTime) + " seconds")
 
+        # Add this run's per-minute counts to the rolling buckets kept between runs, then total the buckets for the mid and long time periods
+        currentMinute = periodStartUTC // 60000
+        updateRollingBuckets(state, logStats["minuteBuckets"], currentMinute - max(longTimePeriod, summaryHourMinutes))
+        midTimePeriodTotals = sumRollingBuckets(state, currentMinute - midTimePeriod)
+        longTimePeriodTotals = sumRollingBuckets(state, currentMinute - longTimePeriod)
+        stageStartTime = recordStage(stageTimings[logFilename], "Rolling totals", stageStartTime)
+
 
         ##########################################################
         ### Post time-based data to ArcGIS Stats Feature Class ###
         ##########################################################
 
-        # Generate portal token
-        # The correct authorisation method needs to be used here. I've used HttpNtlmAuth as that works with Windows single sign on to ArcGIS Portal.
-        # For more info see https://requests.readthedocs.io/en/master/user/authentication/
-        r = requests.post(tokenURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data = {"f": "json"})
-        token = r.json()['token']
-
-        ### General stats ###
+        # Set up the session used for all requests to the portal, which generates the portal token, or reuse it from the last run if running as a daemon
+        portalSession = getPortalSession(tokenURL, domainUsername, domainPassword)
 
-        # Set up feature service URL
-        featureService = fcStatsPerTimePeriodURL
-        addFeaturesURL = featureService + '/addFeatures'
+        # Features for each layer are collected here and then written together
+        layerFeatures = []
 
-        # Set up the data to post
-        data = {
-            "f": "json",
-            "token": token,
-            "features": json.dumps([{
-                "attributes" : {
-                    "StatDateUTC" : statDateUTC,
-                    "ServicesRequested" : servicesRequested,
-                    "LayersDrawn": layersDrawn,
-                    "AvgLayerDrawTime": avgDrawTime,
-                    "Errors" : errors,
-                    "Warnings" : warnings
-                }
-            }])
-        }
-
-        # Post data
-        headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-        r = requests.post(url = addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
+        ### General stats ###
 
-        # log(r.text)
+        layerFeatures.append((fcStatsPerTimePeriodURL, [{
+            "attributes" : {
+                "StatDateUTC" : statDateUTC,
+                "ServicesRequested" : servicesRequested,
+                "LayersDrawn": layersDrawn,
+                "AvgLayerDrawTime": avgDrawTime,
+                "Errors" : errors,
+                "Warnings" : warnings
+            }
+        }]))
 
         ### Errors ###
 
         if errors > 0:
-    
-            # Set up feature service URL
-            featureService = fcErrorsURL
-            addFeaturesURL = featureService + '/addFeatures'
-
-            # Set up the data to post
-            data = {
-                "f": "json",
-                "token": token,
-                "features": json.dumps(errorsDetails)
-            }
-
-            # Post data
-            r = requests.post(url = addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
-
-            # log(r.text)
+            layerFeatures.append((fcErrorsURL, errorsDetails))
 
         ### Warnings ###
 
         if warnings > 0:
 
             # log(warningsDetails)
-
-            # Set up feature service URL
-            featureService = fcWarningsURL
-            addFeaturesURL = featureService + '/addFeatures'
-
-            # Set up the data to post
-            data = {
-                "f": "json",
-                "token": token,
-                "features": json.dumps(warningsDetails)
-            }
-
-            # Post data
-            r = requests.post(url = addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
-
-            # log(r.text)
+            layerFeatures.append((fcWarningsURL, warningsDetails))
 
         ### Service Request Details ###
 
-        # Construct list of services and how many times they were requested
+        # Construct list of services requested in this time period, and how many times they were requested in each time period
         servicesAttributes = []
-        i = 0
-        for service in Counter(servicesDetails).keys():
+        for service in logStats["servicesDetails"]:
             servicesAttributes.append({
                 "attributes" : {
                     "StatDateUTC": statDateUTC,
                     "Service": service,
-                    "ShortTimePeriod": Counter(servicesDetails).values()[i]}
+                    "ShortTimePeriod": logStats["servicesDetails"][service],
+                    "MidTimePeriod": midTimePeriodTotals["services"][service],
+                    "LongTimePeriod": longTimePeriodTotals["services"][service]}
                 })
-            i = i + 1
 
         # log(str(servicesAttributes))
 
@@ -330,86 +308,146 @@ def mainFunction(logFilename,
         # log(str(servicesDetails))
 
         if len(servicesDetails) > 0:
-
-            # Set up feature service URL
-            featureService = fcServicesRequestedURL
-            addFeaturesURL = featureService + '/addFeatures'
-
-            # Set up the data to post
-            data = {
-                "f": "json",
-                "token": token,
-                "features": json.dumps(servicesDetails)
-            }
-
-            # Post data
-            r = requests.post(url = addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
-
-            # log(r.text)
+            layerFeatures.append((fcServicesRequestedURL, servicesDetails))
 
         ### Layers Drawn Details ###
 
-        # Construct list of layers and how many times they were drawn
+        # Construct list of layers drawn in this time period, and how many times they were drawn in each time period
         layersDrawnAttributes = []
-        i = 0
-        for layer in Counter(layersDrawnDetails).keys():
+        for layer in logStats["layersDrawnDetails"]:
             layersDrawnAttributes.append({
                 "attributes" : {
                     "StatDateUTC": statDateUTC,
                     "Layer": layer,
-                    "ShortTimePeriod": Counter(layersDrawnDetails).values()[i]}
+                    "ShortTimePeriod": logStats["layersDrawnDetails"][layer],
+                    "MidTimePeriod": midTimePeriodTotals["layers"][layer],
+                    "LongTimePeriod": longTimePeriodTotals["layers"][layer]}
                 })
-            i = i + 1
 
         layersDrawnDetails = sorted(layersDrawnAttributes, key=lambda k : k['attributes']['ShortTimePeriod'], reverse=True)
 
         if len(layersDrawnDetails) > 0:
-
-            # Set up feature service URL
-            featureService = fcLayersDrawnURL
-            addFeaturesURL = featureService + '/addFeatures'
-
-            # Set up the data to post
-            data = {
-                "f": "json",
-                "token": token,
-                "features": json.dumps(layersDrawnDetails)
-            }
-
-            # Post data
-            r = requests.post(url = addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
-
-            # log(r.text)
+            layerFeatures.append((fcLayersDrawnURL, layersDrawnDetails))
 
         ### Average Layer Draw Times ###
 
-        if len(layersDrawnTimeDetails) > 0:
-
-            # Find average draw times for each layer drawn
-            avgDrawTimeAttributes = []
-            for lyr in layersDrawnTimeDetails:
-                avgDrawTimeAttributes.append({
-                    "attributes" : {
-                        "StatDateUTC": statDateUTC,
-                        "Layer": lyr["layer"],
-                        "ShortTimePeriod": lyr["totalLayerDrawTime"] / lyr["layerCount"]}
+        # Find average draw times in each time period for each layer drawn in this time period, and percentile draw times for this time period
+        avgDrawTimeAttributes = []
+        for layer in logStats["layersDrawnDetails"]:
+            attributes = {
+                "StatDateUTC": statDateUTC,
+                "Layer": layer,
+                "ShortTimePeriod": None,
+                "MidTimePeriod": averageRollingDrawTime(midTimePeriodTotals, layer),
+                "LongTimePeriod": averageRollingDrawTime(longTimePeriodTotals, layer)}
+
+            lyr = layersDrawnTimeDetails.get(layer)
+            if lyr is not None:
+                attributes["ShortTimePeriod"] = lyr["totalLayerDrawTime"] / lyr["layerCount"]
+                attributes["P50DrawTime"] = drawTimePercentile(lyr, 50)
+                attributes["P95DrawTime"] = drawTimePercentile(lyr, 95)
+                attributes["P99DrawTime"] = drawTimePercentile(lyr, 99)
+
+            avgDrawTimeAttributes.append({"attributes": attributes})
+
+        if len(avgDrawTimeAttributes) > 0:
+            layerFeatures.append((fcAvgLayerDrawTimeURL, avgDrawTimeAttributes))
+
+        ### Services Requested by User ###
+
+        # Construct list of the user/service pairs with the most requests, and one row for the requests made by all other pairs
+        userServiceRequestsAttributes = []
+        topUserServiceRequestsCount = 0
+        for (gisUser, service), requestCount in logStats["userServiceRequests"].mostCommon(topUserServiceRequests):
+            topUserServiceRequestsCount += requestCount
+            userServiceRequestsAttributes.append({
+                "attributes" : {
+                    "StatDateUTC": statDateUTC,
+                    "GISUser": gisUser,
+                    "Service": service,
+                    "ShortTimePeriod": requestCount}
                 })
 
-            # Set up feature service URL
-            featureService = fcAvgLayerDrawTimeURL
-            addFeaturesURL = featureService + '/addFeatures'
-
-            # Set up the data to post
-            data = {
-                "f": "json",
-                "token": token,
-                "features": json.dumps(avgDrawTimeAttributes)
-            }
+        otherUserServiceRequestsCount = logStats["userServiceRequests"].total - topUserServiceRequestsCount
+        if otherUserServiceRequestsCount > 0:
+            userServiceRequestsAttributes.append({
+                "attributes" : {
+                    "StatDateUTC": statDateUTC,
+                    "GISUser": "Other",
+                    "Service": "Other",
+                    "ShortTimePeriod": otherUserServiceRequestsCount}
+                })
 
-            # Post data
-            r = requests.post(url = addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
+        if len(userServiceRequestsAttributes) > 0:
+            layerFeatures.append((fcServicesRequestedByUserURL, userServiceRequestsAttributes))
 
-            # log(r.text)
+        # Save the features to the outbox along with the checkpoint for the next run - the time of the most recent message processed, and the
+        # messages at that time so they are not counted again. Both are saved in one transaction, so a run that stops part way can neither move
+        # the checkpoint on without its stats nor keep its stats without the checkpoint (which would count them again next run). The features
+        # wait in the outbox until they have been sent, so a run's stats can't be lost if the portal is down or slow.
+        if logStats["latestLogTimeUTC"] is not None:
+            checkpoint = {"lastLogTimeUTC": logStats["latestLogTimeUTC"], "boundaryHashes": sorted(logStats["latestLogHashes"])}
+        else:
+            checkpoint = {"lastLogTimeUTC": periodStartUTC, "boundaryHashes": []}
+        outbox.add([(layerURL, "add", None, features) for layerURL, features in layerFeatures], checkpoint)
+        publishingSummaries = fcDailyTotalsURL or fcTopServicesURL or fcTopLayersURL
+        if publishingSummaries:
+            todayTotals = updateTodayTotals(state, logStats, statDateUTC)
+        saveState(stateFile, state)
+        stageStartTime = recordStage(stageTimings[logFilename], "Save outbox", stageStartTime)
+
+        # Post data - this run's features, and any left in the outbox by earlier runs
+        outboxSent = flushOutbox(outbox, portalSession, log, outboxFlushSeconds, useApplyEdits == "true", applyEditsMaxFeatures)
+
+        ### Dashboard Summaries ###
+
+        # Small layers the dashboard reads single rows from, rather than totalling the rows for every run. They are updated in place each run,
+        # unless the outbox couldn't be sent - the portal is down or slow, or the run is out of time - in which case the next run updates them.
+        if publishingSummaries and not outboxSent:
+            log("The outbox was not sent in full, so the dashboard summaries will be updated next run")
+        elif publishingSummaries:
+            hourTotals = sumRollingBuckets(state, currentMinute - summaryHourMinutes)
+            summaryLayers = []
+
+            if fcDailyTotalsURL:
+                # Today's row, found by its day. Earlier days' rows are left as they are.
+                summaryLayers.append((fcDailyTotalsURL, [{
+                    "Day": todayTotals["dateUTC"][:10],
+                    "StatDateUTC": todayTotals["dateUTC"],
+                    "ServicesRequested": todayTotals["servicesRequested"],
+                    "LayersDrawn": todayTotals["layersDrawn"],
+                    "AvgLayerDrawTime": (1.0 * todayTotals["totalDrawTime"] / todayTotals["timedDraws"]) if todayTotals["timedDraws"] else 0,
+                    "Errors": todayTotals["errors"],
+                    "Warnings": todayTotals["warnings"],
+                    "LastUpdateUTC": statDateUTC}], ["Day"], "Day = '" + todayTotals["dateUTC"][:10] + "'", False))
+
+            if fcTopServicesURL:
+                # A row for each rank in each period. Ranks no longer needed (e.g. fewer services were requested in the last hour) are removed.
+                topServices = []
+                for period, totals in [("Hour", hourTotals), ("Today", todayTotals)]:
+                    for rank, (service, requestCount) in enumerate(Counter(totals["services"]).most_common(topSummaryCount)):
+                        topServices.append({"Period": period, "Rank": rank + 1, "Service": service, "Requests": requestCount, "LastUpdateUTC": statDateUTC})
+                summaryLayers.append((fcTopServicesURL, topServices, ["Period", "Rank"], "1=1", True))
+
+            if fcTopLayersURL:
+                topLayers = []
+                for period, totals in [("Hour", hourTotals), ("Today", todayTotals)]:
+                    for rank, (layer, drawCount) in enumerate(Counter(totals["layers"]).most_common(topSummaryCount)):
+                        topLayers.append({"Period": period, "Rank": rank + 1, "Layer": layer, "Draws": drawCount,
+                                          "AvgDrawTime": averageRollingDrawTime(totals, layer), "LastUpdateUTC": statDateUTC})
+                summaryLayers.append((fcTopLayersURL, topLayers, ["Period", "Rank"], "1=1", True))
+
+            # The summary rows' object ids are kept in their own small file, which is only written when rows have been added or removed
+            summaryObjectIdsFile = os.path.join(stateFolder, os.path.splitext(logFilename)[0] + "_summaries.json")
+            summaryObjectIds = loadState(summaryObjectIdsFile)
+            knownObjectIds = json.dumps(summaryObjectIds, sort_keys=True)
+            publishSummaries(summaryLayers, summaryObjectIds, portalSession)
+            if json.dumps(summaryObjectIds, sort_keys=True) != knownObjectIds:
+                saveState(summaryObjectIdsFile, summaryObjectIds)
+
+        log(portalSession.summary())
+        recordStage(stageTimings[logFilename], "Publish", stageStartTime)
+        log("Stage timings: " + stageTimingsSummary(stageTimings[logFilename]))
 
         # --------------------------------------- End of code --------------------------------------- #  
             
@@ -417,7 +455,7 @@ def mainFunction(logFilename,
         if __name__ == '__main__':
 
             # Return the output if there is any
-            if output:
+            if output and arcpy:
                 arcpy.SetParameterAsText(1, output)
 
         # Otherwise return the result          
@@ -439,11 +477,11 @@ def mainFunction(logFilename,
         pass
 
     # If arcpy error
-    except arcpy.ExecuteError:           
+    except ArcpyExecuteError:           
 
         # Build and show the error message
         errorMessage = arcpy.GetMessages(2)   
-        arcpy.AddError(errorMessage)           
+        addError(errorMessage)           
 
         # Logging
         if loggingEnabled:
@@ -473,16 +511,16 @@ def mainFunction(logFilename,
 
             if (i == 0):
                 try:
-                    errorMessage = unicode(e.args[i]).encode('utf-8')
+                    errorMessage = errorText(e.args[i])
                 except Exception:
                     errorMessage = 'Unable to encode error message component'
             else:
                 try:
-                    errorMessage = errorMessage + " " + unicode(e.args[i]).encode('utf-8')
+                    errorMessage = errorMessage + " " + errorText(e.args[i])
                 except Exception:
                     errorMessage = 'Unable to encode error message component'
 
-        arcpy.AddError(errorMessage)              
+        addError(errorMessage)              
 
         # Logging
         if loggingEnabled:
@@ -505,38 +543,940 @@ def mainFunction(logFilename,
 # End of main function
 
 
-# A function to generate a token given username, password and the adminURL.
-def getToken(username, password, serverName, serverPort):
+# A counter that keeps a fixed number of keys, using the Space-Saving algorithm. When it is full, a new key replaces the key with the
+# smallest count and takes over that count, so keys with more requests than the smallest count are never dropped and the top keys are reliable.
+class SpaceSavingCounter(object):
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.total = 0
+        self.heap = [] # One (count, key) entry per key. An entry's count can be lower than the key's current count, and is only brought up to date when it reaches the top of the heap
+
+    # Add to the count for a key
+    def add(self, key, count=1):
+        self.total += count
+
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            heappush(self.heap, (count, key))
+        else:
+            # Replace the key with the smallest count
+            while True:
+                smallestCount, smallestKey = heappop(self.heap)
+                if self.counts[smallestKey] == smallestCount:
+                    break
+                heappush(self.heap, (self.counts[smallestKey], smallestKey))
+
+            del self.counts[smallestKey]
+            self.counts[key] = smallestCount + count
+            heappush(self.heap, (smallestCount + count, key))
+
+    # Add the counts from another counter, keeping the keys with the largest combined counts
+    def merge(self, other):
+        combinedCounts = Counter(self.counts)
+        combinedCounts.update(other.counts)
+        self.counts = dict(combinedCounts.most_common(self.capacity))
+        self.total += other.total
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        self.heap.sort()
+
+    # Return the keys with the largest counts, largest first
+    def mostCommon(self, n):
+        return Counter(self.counts).most_common(n)
+
+
+# A pool of keep-alive connections to the ArcGIS Server admin API, shared by every admin request made in a run.
+class AdminConnectionPool(object):
+
+    def __init__(self, serverName, serverPort, poolSize, timeout, protocol="http"):
+        self.serverName = serverName
+        self.serverPort = serverPort
+        self.timeout = timeout
+        self.protocol = protocol
+        self.idleConnections = Queue.LifoQueue(poolSize)
+        self.lock = threading.Lock()
+        self.token = None
+        self.tokenExpires = 0
+        self.resetCounts()
+
+    # Start counting connections again for a new run
+    def resetCounts(self):
+        self.connectionsOpened = 0
+        self.connectionsReused = 0
+
+    # Take an idle connection from the pool, or open a new one if there are none
+    def getConnection(self):
+        try:
+            httpConn = self.idleConnections.get_nowait()
+            with self.lock:
+                self.connectionsReused += 1
+            return httpConn, True
+        except Queue.Empty:
+            if self.protocol == "https":
+                httpConn = httplib.HTTPSConnection(self.serverName, self.serverPort, timeout=self.timeout)
+            else:
+                httpConn = httplib.HTTPConnection(self.serverName, self.serverPort, timeout=self.timeout)
+            with self.lock:
+                self.connectionsOpened += 1
+            return httpConn, False
+
+    # Put a connection back in the pool so the next request can reuse it, or close it if the pool is full
+    def releaseConnection(self, httpConn):
+        try:
+            self.idleConnections.put_nowait(httpConn)
+        except Queue.Full:
+            httpConn.close()
+
+    # Post parameters to a URL on the server and return the response status and body. If a function to read the response is given, it is
+    # passed the response to read as it arrives, and what it returns is returned in place of the body.
+    def post(self, url, params, headers, readResponse=None):
+        httpConn, reused = self.getConnection()
+        try:
+            httpConn.request("POST", url, params, headers)
+            response = httpConn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            httpConn.close()
+
+            # The server has closed an idle keep-alive connection, so try again once on a new connection. Any other error, such as a timeout,
+            # is raised rather than sending the request again, as the server may already have acted on it.
+            if reused and staleConnectionError(e):
+                return self.post(url, params, headers, readResponse)
+            raise
+
+        # Not retried once reading has started, as the response may already have been partly used
+        try:
+            if readResponse is None:
+                data = response.read()
+            else:
+                data = readResponse(response)
+        except Exception:
+            httpConn.close()
+            raise
+
+        # The whole response has been read, so the connection can be used again unless the server is closing it
+        if response.will_close:
+            httpConn.close()
+        else:
+            self.releaseConnection(httpConn)
+
+        return response.status, data
+
+    # Close all idle connections
+    def close(self):
+        while True:
+            try:
+                self.idleConnections.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+# A function that checks whether an error sending a request on a kept-alive connection is because the server had already closed the connection,
+# before any of the response arrived - the connection was reset, or closed without a status line being sent.
+def staleConnectionError(e):
+
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return getattr(e, "errno", None) in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+
+# A function to generate a token given username, password and the pool of admin connections.
+def getToken(username, password, connectionPool):
 
     tokenURL = "/arcgis/admin/generateToken"
     
     # URL-encode the token parameters
-    params = urllib.urlencode({'username': username, 'password': password, 'client': 'requestip', 'f': 'json'})
+    params = urlencode({'username': username, 'password': password, 'client': 'requestip', 'expiration': tokenExpiration, 'f': 'json'})
     
     headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
     
-    # Connect to URL and post parameters
-    httpConn = httplib.HTTPConnection(serverName, serverPort)
-    httpConn.request("POST", tokenURL, params, headers)
-    
-    # Read response
-    response = httpConn.getresponse()
-    if (response.status != 200):
-        httpConn.close()
+    # Post parameters on a pooled connection and read response
+    responseStatus, data = connectionPool.post(tokenURL, params, headers)
+    if (responseStatus != 200):
         print("Error while fetching tokens from admin URL. Please check the URL and try again.")
         return
     else:
-        data = response.read()
-        httpConn.close()
-        
         # Check that data returned is not an error object
         if not assertJsonSuccess(data):            
             return
         
-        # Extract the toke from it
-        token = json.loads(data)       
-        return token['token']            
-        
+        # Extract the token and when it expires from it
+        token = json.loads(data)
+        return token['token'], tokenExpiryTime(token, tokenExpiration)
+
+
+# A function that returns the admin connection pool and token for a server, reusing them from the last run when running as a daemon (or from another site when run from run_all_stats.py).
+# A new token is only generated when the current one is about to expire.
+def getAdminSession(serverHostname, serverPort, serverUsername, serverPassword):
+
+    key = ("admin", serverHostname, serverPort, serverUsername)
+    with warmSessionsLock:
+        adminConnectionPool = warmSessions.get(key)
+        if adminConnectionPool is None:
+            adminConnectionPool = AdminConnectionPool(serverHostname, serverPort, max(adminConnectionPoolSize, logFetchSlices), adminConnectionTimeout, adminProtocol)
+        else:
+            adminConnectionPool.resetCounts()
+
+        if adminConnectionPool.token is None or tokenExpiring(adminConnectionPool.tokenExpires, tokenRefreshMargin):
+            tokenInfo = getToken(serverUsername, serverPassword, adminConnectionPool)
+            if not tokenInfo:
+                return adminConnectionPool, None
+            adminConnectionPool.token, adminConnectionPool.tokenExpires = tokenInfo
+
+        if keepSessions == "true":
+            warmSessions[key] = adminConnectionPool
+    return adminConnectionPool, adminConnectionPool.token
+
+
+# A function that returns the portal session for a portal and user, reusing it from the last run when running as a daemon (or from another site when run from run_all_stats.py)
+def getPortalSession(tokenURL, domainUsername, domainPassword):
+
+    key = ("portal", tokenURL, domainUsername)
+    with warmSessionsLock:
+        portalSession = warmSessions.get(key)
+        if portalSession is None:
+            portalSession = PortalSession(tokenURL, domainUsername, domainPassword, tokenExpiration, tokenRefreshMargin, portalRequestTimeout)
+            if keepSessions == "true":
+                warmSessions[key] = portalSession
+
+    # Count this run's requests on their own, as other sites may be using the session at the same time
+    return portalSession.forRun()
+
+
+# A function that pages through the server logs between two times and returns the running totals, or None if the logs could not be queried.
+# startTime is the most recent time and endTime the oldest, as expected by the logs/query operation.
+def fetchLogs(connectionPool, token, startTime, endTime, statDateUTC, checkpoint=None):
+
+    # Construct URL to query the logs
+    noOfLogMessagesPerPage = 10000
+    logQueryURL = "/arcgis/admin/logs/query"
+    logFilter = "{'services':'*','server':'*','machines':'*'}"
+    headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+
+    # Request logs from server. These come in batches of up to 10,000 messages at a time, so need to use loop to make sure we get all the messages.
+    # Each batch is folded into the running totals as it arrives, so only one batch is held in memory at a time.
+    receivedAllLogs = False
+    logStats = createLogStats(checkpoint)
+
+    while not receivedAllLogs:
+
+        # Set parameters
+        log('startTime: ' + str(startTime))
+        log('endTime: ' + str(endTime))
+        params = urlencode({'level': 'FINE', 'startTime': startTime, 'endTime': endTime, 'filter':logFilter, 'token': token, 'pageSize': noOfLogMessagesPerPage, 'f': 'json'})
+
+        # Post parameters on a pooled connection, decoding the log messages into columns as the response arrives
+        logColumns = LogColumns()
+        try:
+            responseStatus, dataObj = connectionPool.post(logQueryURL, params, headers, lambda response: decodeLogPage(response, logColumns))
+        except socket.timeout:
+            log("Timed out while querying logs")
+            return None
+        if (responseStatus != 200):
+            log("Error while querying logs")
+            return None
+
+        # Check that data returned is not an error object. The rest of the logs haven't been fetched, so don't return the partial totals
+        # - the checkpoint would move past the logs that were missed.
+        if dataObj.get("status") == "error":
+            log("Error returned by operation " + json.dumps(dataObj))
+            return None
+
+        # Add this batch to the running totals
+        aggregateLogMessages(logStats, logColumns, statDateUTC)
+
+        if dataObj.get("hasMore"):
+
+            # Find date of oldest log message retrieved
+            oldestLogDateUTC = int(logColumns.time[len(logColumns) - 1])
+            startTime = oldestLogDateUTC - 1 # Subtract one millisecond so we don't get any repeated logs between the batches.
+        else:
+            log('Received all logs')
+            receivedAllLogs = True
+
+    return logStats
+
+
+# A function that splits a time period into a number of equal, non-overlapping slices. Times are in milliseconds, most recent first.
+def splitTimePeriod(startTime, endTime, slices):
+
+    sliceLength = (startTime - endTime + 1) // max(slices, 1)
+    if slices <= 1 or sliceLength < 1:
+        return [(startTime, endTime)]
+
+    timeSlices = []
+    for i in range(slices):
+        sliceStart = startTime - (i * sliceLength)
+        if i == slices - 1:
+            sliceEnd = endTime
+        else:
+            sliceEnd = sliceStart - sliceLength + 1
+        timeSlices.append((sliceStart, sliceEnd))
+
+    return timeSlices
+
+
+# A batch of log messages held as columns rather than as a dict for each message. Times, codes and elapsed times are held in arrays, and strings
+# are dictionary encoded - each distinct string is held once in the string table, and the string columns hold its position in the table.
+class LogColumns(object):
+
+    stringFields = ["type", "source", "machine", "process", "thread", "user", "message"]
+
+    def __init__(self):
+        self.time = array("d") # Milliseconds are held exactly as doubles, and unlike long arrays doubles are 64 bit on Windows
+        self.code = array("l")
+        self.elapsed = array("d") # -1 if the message has no elapsed time
+        self.strings = []
+        self.stringIds = {}
+        self.stringColumns = dict((field, array("l")) for field in self.stringFields)
+        self.stringColumnList = [(field, self.stringColumns[field].append) for field in self.stringFields]
+
+    def __len__(self):
+        return len(self.time)
+
+    # Add a log message to the end of the columns
+    def append(self, item):
+        self.time.append(item["time"])
+        self.code.append(item.get("code") or 0)
+        elapsed = item.get("elapsed")
+        self.elapsed.append(float(elapsed) if elapsed not in (None, "") else -1.0)
+
+        stringIds = self.stringIds
+        for field, appendToColumn in self.stringColumnList:
+            value = item.get(field, "")
+            try:
+                appendToColumn(stringIds[value])
+            except KeyError:
+                stringIds[value] = len(self.strings)
+                self.strings.append(value)
+                appendToColumn(stringIds[value])
+
+    # Rebuild the nth log message as a dict. Only used for the few messages that need all of their fields, e.g. errors and warnings.
+    def message(self, i):
+        item = dict((field, self.strings[self.stringColumns[field][i]]) for field in self.stringFields)
+        item["time"] = int(self.time[i])
+        item["code"] = self.code[i]
+        return item
+
+
+# A decoder that reads a logs/query response as it arrives, and adds each log message to the columns as soon as it has been decoded. Neither
+# the whole response nor a dict for every message is held at once, and the response is only parsed once. The other fields of the response
+# (hasMore, status, messages etc) are returned.
+class LogPageDecoder(object):
+
+    whitespace = re.compile(r"[ \t\n\r]*")
+    chunkSize = 65536 # Bytes read from the response at a time
+
+    def __init__(self, response, logColumns):
+        self.response = response
+        self.logColumns = logColumns
+        self.textDecoder = codecs.getincrementaldecoder("utf-8")()
+        self.jsonDecoder = json.JSONDecoder()
+        self.buffer = u""
+        self.pos = 0
+        self.endOfResponse = False
+
+    # Read the next chunk of the response, dropping what has already been decoded from the buffer. Returns False if there is nothing left to read.
+    def readMore(self):
+        if self.endOfResponse:
+            return False
+
+        chunk = self.response.read(self.chunkSize)
+        self.endOfResponse = not chunk
+        self.buffer = self.buffer[self.pos:] + self.textDecoder.decode(chunk, self.endOfResponse)
+        self.pos = 0
+        return True
+
+    # Skip any whitespace and return the next character
+    def peek(self):
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.readMore():
+                raise ValueError("Log query response ended unexpectedly")
+
+    # Skip the next character, which should be the one given
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected '" + character + "' in log query response, found '" + self.buffer[self.pos:self.pos + 20] + "'")
+        self.pos += 1
+
+    # Decode the next value, reading more of the response until all of the value has arrived
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.jsonDecoder.raw_decode(self.buffer, self.pos)
+
+                # A number at the end of the buffer may carry on in the next chunk
+                if end < len(self.buffer) or self.endOfResponse:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.endOfResponse:
+                    raise
+            self.readMore()
+
+    # Decode the log messages in the list and add them to the columns
+    def logMessages(self):
+        rawDecode = self.jsonDecoder.raw_decode
+        appendToColumns = self.logColumns.append
+        skipWhitespace = self.whitespace.match
+
+        while True:
+            # Most messages are already in the buffer straight after the last one, so try decoding them directly first
+            try:
+                item, end = rawDecode(self.buffer, self.pos)
+                if end >= len(self.buffer):
+                    raise ValueError("Log message may carry on in the next chunk")
+                self.pos = end
+            except ValueError:
+                item = self.value()
+            appendToColumns(item)
+
+            if self.buffer[self.pos:self.pos + 1] == "," or self.peek() == ",":
+                self.pos = skipWhitespace(self.buffer, self.pos + 1).end()
+            else:
+                break
+
+    # Decode the response
+    def decode(self):
+        fields = {}
+        self.expect("{")
+        if self.peek() == "}":
+            return fields
+
+        while True:
+            key = self.value()
+            self.expect(":")
+
+            # Log messages are added to the columns one at a time, rather than decoding the whole list
+            if key == "logMessages" and self.peek() == "[":
+                self.pos += 1
+                if self.peek() == "]":
+                    self.pos += 1
+                else:
+                    self.logMessages()
+                    self.expect("]")
+            else:
+                fields[key] = self.value()
+
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        self.expect("}")
+
+        return fields
+
+
+# A function that decodes a logs/query response into columns of log messages as it arrives, and returns the other fields of the response.
+# Error responses (which are not JSON) are read and returned as they are.
+def decodeLogPage(response, logColumns):
+
+    if response.status != 200:
+        return response.read()
+
+    fields = LogPageDecoder(response, logColumns).decode()
+
+    # Read anything after the end of the JSON (e.g. a trailing newline), so the connection can be reused
+    response.read()
+    return fields
+
+
+# A function that creates the running totals which batches of log messages are added to.
+# Messages already processed at the time of the checkpoint (if any) will be skipped.
+def createLogStats(checkpoint=None):
+
+    if checkpoint:
+        checkpointTimeUTC = checkpoint["lastLogTimeUTC"]
+        checkpointHashes = set(checkpoint["boundaryHashes"])
+    else:
+        checkpointTimeUTC = None
+        checkpointHashes = set()
+
+    return {
+        "checkpointTimeUTC": checkpointTimeUTC,
+        "checkpointHashes": checkpointHashes,
+        "latestLogTimeUTC": None,
+        "latestLogHashes": set(),
+        "messages": 0,
+        "servicesRequested": 0,
+        "layersDrawn": 0,
+        "timedDraws": 0,
+        "totalDrawTime": 0,
+        "errors": 0,
+        "warnings": 0,
+        "errorGroups": {},
+        "warningGroups": {},
+        "servicesDetails": Counter(),
+        "layersDrawnDetails": Counter(),
+        "layersDrawnTimeDetails": {},
+        "minuteBuckets": {},
+        "userServiceRequests": SpaceSavingCounter(userServiceRequestsCapacity),
+        "classifierTable": createClassifierTable()
+        }
+
+
+# A function that adds a batch of log messages to the running totals. None of the totals depend on the order of the messages.
+# Each message is passed to the classifiers for its code, message and type - most messages have none, so are only counted.
+def aggregateLogMessages(logStats, logColumns, statDateUTC):
+
+    times = logColumns.time
+    codes = logColumns.code
+    types = logColumns.stringColumns["type"]
+    messages = logColumns.stringColumns["message"]
+
+    # Messages and types are looked up by their position in the page's string table, which is quicker than comparing the strings
+    classifierTable = logStats["classifierTable"]
+    codeClassifiers = classifierTable["codes"]
+    messageClassifiers = dict((logColumns.stringIds[message], classifiers) for message, classifiers in classifierTable["messages"].items() if message in logColumns.stringIds)
+    typeClassifiers = dict((logColumns.stringIds[logType], classifiers) for logType, classifiers in classifierTable["types"].items() if logType in logColumns.stringIds)
+
+    # Times are compared in the loop as numbers, with -1 when there is no time yet
+    latestLogTimeUTC = logStats["latestLogTimeUTC"] if logStats["latestLogTimeUTC"] is not None else -1
+    checkpointTimeUTC = logStats["checkpointTimeUTC"] if logStats["checkpointTimeUTC"] is not None else -1
+    skipped = 0
+
+    for i in range(len(logColumns)):
+
+        logTimeUTC = int(times[i])
+
+        # Keep track of the most recent messages for the next checkpoint
+        messageHash = None
+        if logTimeUTC >= latestLogTimeUTC:
+            messageHash = logMessageHash(logColumns.message(i))
+            if logTimeUTC > latestLogTimeUTC:
+                latestLogTimeUTC = logStats["latestLogTimeUTC"] = logTimeUTC
+                logStats["latestLogHashes"] = set([messageHash])
+            else:
+                logStats["latestLogHashes"].add(messageHash)
+
+        # Skip messages already processed by the previous run
+        if logTimeUTC == checkpointTimeUTC:
+            if (messageHash or logMessageHash(logColumns.message(i))) in logStats["checkpointHashes"]:
+                skipped += 1
+                continue
+
+        if codes[i] in codeClassifiers:
+            for classifier in codeClassifiers[codes[i]]:
+                classifier(logStats, logColumns, i, logTimeUTC)
+
+        if messages[i] in messageClassifiers:
+            for classifier in messageClassifiers[messages[i]]:
+                classifier(logStats, logColumns, i, logTimeUTC)
+
+        if types[i] in typeClassifiers:
+            for classifier in typeClassifiers[types[i]]:
+                classifier(logStats, logColumns, i, logTimeUTC)
+
+    logStats["messages"] += len(logColumns) - skipped
+
+
+# A function that registers a classifier - a function that adds a log message to the running totals - for log messages with any of the
+# given codes, exact messages or types. Classifiers are called with the running totals, the columns and the position of the message in them,
+# and the message time. E.g. to count another operation with an elapsed time, register a classifier for its "End ..." message.
+def registerClassifier(classifier, codes=(), messages=(), types=()):
+
+    logMessageClassifiers.append({"classifier": classifier, "codes": list(codes), "messages": list(messages), "types": list(types)})
+
+
+# A function that builds the table used to look up the classifiers for a log message by its code, message or type
+def createClassifierTable():
+
+    classifierTable = {"codes": {}, "messages": {}, "types": {}}
+    for registration in logMessageClassifiers:
+        for field in ["codes", "messages", "types"]:
+            for value in registration[field]:
+                classifierTable[field].setdefault(value, []).append(registration["classifier"])
+    return classifierTable
+
+
+# A function that counts a service request (code 9029), other than requests from this script to the stats feature service
+def classifyServiceRequest(logStats, logColumns, i, logTimeUTC):
+
+    message = logColumns.strings[logColumns.stringColumns["message"][i]]
+    if message.endswith('Stats/ArcGISStatsIntGIS/FeatureServer'):
+        return
+
+    logStats["servicesRequested"] += 1
+    servicePos = message.find("Service: ")
+    serviceName = message[servicePos + len("Service: "):]
+    logStats["servicesDetails"][serviceName] += 1
+    getMinuteBucket(logStats, logTimeUTC)["services"][serviceName] += 1
+    logStats["userServiceRequests"].add((logColumns.strings[logColumns.stringColumns["user"][i]] or "Anonymous", serviceName))
+
+
+# A function that counts a layer drawn and its draw time. A draw whose message has no elapsed time is counted, but left out of the draw times.
+def classifyLayerDraw(logStats, logColumns, i, logTimeUTC):
+
+    drawTime = logColumns.elapsed[i]
+    source = logColumns.strings[logColumns.stringColumns["source"][i]]
+    logStats["layersDrawn"] += 1
+    logStats["layersDrawnDetails"][source] += 1
+    minuteBucket = getMinuteBucket(logStats, logTimeUTC)
+    minuteBucket["layers"][source] += 1
+    if drawTime < 0:
+        return
+
+    logStats["timedDraws"] += 1
+    logStats["totalDrawTime"] += drawTime
+
+    layerDrawTimes = logStats["layersDrawnTimeDetails"].get(source)
+    if layerDrawTimes is None:
+        layerDrawTimes = logStats["layersDrawnTimeDetails"][source] = createDrawTimeStats()
+    addDrawTime(layerDrawTimes, drawTime)
+
+    minuteBucket["timedLayers"][source] += 1
+    minuteBucket["layerDrawTimes"][source] += drawTime
+
+
+# A function that counts an error and adds it to its message group
+def classifyError(logStats, logColumns, i, logTimeUTC):
+
+    logStats["errors"] += 1
+    addToMessageGroup(logStats["errorGroups"], logColumns.message(i))
+
+
+# A function that counts a warning and adds it to its message group
+def classifyWarning(logStats, logColumns, i, logTimeUTC):
+
+    logStats["warnings"] += 1
+    addToMessageGroup(logStats["warningGroups"], logColumns.message(i))
+
+
+registerClassifier(classifyServiceRequest, codes=[9029]) # 9029 == Service requested
+registerClassifier(classifyLayerDraw, messages=["End ExportMapImage"])
+registerClassifier(classifyError, types=["SEVERE"])
+registerClassifier(classifyWarning, types=["WARNING"])
+
+
+# A function that adds one set of running totals to another, e.g. when the logs have been fetched in time slices.
+def mergeLogStats(logStats, otherStats):
+
+    if otherStats["latestLogTimeUTC"] is not None:
+        if logStats["latestLogTimeUTC"] is None or otherStats["latestLogTimeUTC"] > logStats["latestLogTimeUTC"]:
+            logStats["latestLogTimeUTC"] = otherStats["latestLogTimeUTC"]
+            logStats["latestLogHashes"] = otherStats["latestLogHashes"]
+        elif otherStats["latestLogTimeUTC"] == logStats["latestLogTimeUTC"]:
+            logStats["latestLogHashes"] |= otherStats["latestLogHashes"]
+
+    for key in ["messages", "servicesRequested", "layersDrawn", "timedDraws", "totalDrawTime", "errors", "warnings"]:
+        logStats[key] += otherStats[key]
+
+    mergeMessageGroups(logStats["errorGroups"], otherStats["errorGroups"])
+    mergeMessageGroups(logStats["warningGroups"], otherStats["warningGroups"])
+    logStats["servicesDetails"].update(otherStats["servicesDetails"])
+    logStats["layersDrawnDetails"].update(otherStats["layersDrawnDetails"])
+
+    for layer, otherDrawTimes in otherStats["layersDrawnTimeDetails"].items():
+        layerDrawTimes = logStats["layersDrawnTimeDetails"].get(layer)
+        if layerDrawTimes is None:
+            logStats["layersDrawnTimeDetails"][layer] = otherDrawTimes
+        else:
+            layerDrawTimes["totalLayerDrawTime"] += otherDrawTimes["totalLayerDrawTime"]
+            layerDrawTimes["layerCount"] += otherDrawTimes["layerCount"]
+            layerDrawTimes["drawTimeHistogram"].update(otherDrawTimes["drawTimeHistogram"])
+
+    logStats["userServiceRequests"].merge(otherStats["userServiceRequests"])
+
+    for minute, minuteBucket in otherStats["minuteBuckets"].items():
+        if minute in logStats["minuteBuckets"]:
+            addToMinuteBucket(logStats["minuteBuckets"][minute], minuteBucket)
+        else:
+            logStats["minuteBuckets"][minute] = minuteBucket
+
+
+# A function that returns the template of a log message, with the parts that change between occurrences of the same problem (numbers, GUIDs, extents) replaced
+def messageTemplate(message):
+
+    for pattern, replacement in messageTemplatePatterns:
+        message = pattern.sub(replacement, message)
+    return message
+
+
+# A function that adds an error or warning message to the group of messages with the same fingerprint - the same code, source and message template.
+# Each group keeps a count, the first and last times it was logged and the most recent message as a sample.
+def addToMessageGroup(messageGroups, item):
+
+    key = (item["code"], item["source"], messageTemplate(item["message"]))
+    messageGroup = messageGroups.get(key)
+    if messageGroup is None:
+        messageGroups[key] = {"occurrences": 1, "firstLogTimeUTC": item["time"], "lastLogTimeUTC": item["time"], "message": item["message"], "user": item["user"]}
+    else:
+        messageGroup["occurrences"] += 1
+        messageGroup["firstLogTimeUTC"] = min(messageGroup["firstLogTimeUTC"], item["time"])
+        if item["time"] >= messageGroup["lastLogTimeUTC"]:
+            messageGroup["lastLogTimeUTC"] = item["time"]
+            messageGroup["message"] = item["message"]
+            messageGroup["user"] = item["user"]
+
+
+# A function that adds one set of message groups to another
+def mergeMessageGroups(messageGroups, otherGroups):
+
+    for key, otherGroup in otherGroups.items():
+        messageGroup = messageGroups.get(key)
+        if messageGroup is None:
+            messageGroups[key] = otherGroup
+        else:
+            messageGroup["occurrences"] += otherGroup["occurrences"]
+            messageGroup["firstLogTimeUTC"] = min(messageGroup["firstLogTimeUTC"], otherGroup["firstLogTimeUTC"])
+            if otherGroup["lastLogTimeUTC"] >= messageGroup["lastLogTimeUTC"]:
+                messageGroup["lastLogTimeUTC"] = otherGroup["lastLogTimeUTC"]
+                messageGroup["message"] = otherGroup["message"]
+                messageGroup["user"] = otherGroup["user"]
+
+
+# A function that returns a feature for each message group, most occurrences first. The fingerprint is the same in every run, so a problem can be followed over time.
+def messageGroupFeatures(messageGroups, statDateUTC):
+
+    features = []
+    for key, messageGroup in sorted(messageGroups.items(), key=lambda k: k[1]["occurrences"], reverse=True):
+        code, source, template = key
+        fingerprint = hashlib.md5(u"|".join([str(code), source, template]).encode("utf-8")).hexdigest()
+        features.append({
+            "attributes" : {
+                "StatDateUTC": statDateUTC,
+                "LogDateUTC": messageGroup["lastLogTimeUTC"],
+                "FirstLogDateUTC": messageGroup["firstLogTimeUTC"],
+                "Occurrences": messageGroup["occurrences"],
+                "Fingerprint": fingerprint,
+                "Message": messageGroup["message"],
+                "Source": source,
+                "Code": code,
+                "GISUser": messageGroup["user"]}
+            })
+    return features
+
+
+# A function that creates the draw time totals for a layer. Draw times are also counted in a histogram of exponentially widening buckets,
+# which takes a fixed amount of memory however many draws there are, and can simply be added together when merging.
+def createDrawTimeStats():
+
+    return {
+        "totalLayerDrawTime": 0.0,
+        "layerCount": 0,
+        "drawTimeHistogram": Counter()
+        }
+
+
+# A function that adds a draw time (in seconds) to a layer's draw time totals.
+def addDrawTime(layerDrawTimes, drawTime):
+
+    layerDrawTimes["totalLayerDrawTime"] += drawTime
+    layerDrawTimes["layerCount"] += 1
+
+    if drawTime <= drawTimeHistogramMinimum:
+        bucket = 0
+    else:
+        bucket = int(math.ceil(math.log(drawTime / drawTimeHistogramMinimum) / math.log(drawTimeHistogramGrowth)))
+    layerDrawTimes["drawTimeHistogram"][bucket] += 1
+
+
+# A function that estimates a percentile (e.g. 95) of a layer's draw times from its histogram, using the middle of the bucket the percentile falls in.
+def drawTimePercentile(layerDrawTimes, percentile):
+
+    rank = math.ceil(layerDrawTimes["layerCount"] * percentile / 100.0)
+    drawCount = 0
+    for bucket in sorted(layerDrawTimes["drawTimeHistogram"].keys()):
+        drawCount += layerDrawTimes["drawTimeHistogram"][bucket]
+        if drawCount >= rank:
+            break
+
+    if bucket == 0:
+        return drawTimeHistogramMinimum
+    return drawTimeHistogramMinimum * math.pow(drawTimeHistogramGrowth, bucket - 0.5)
+
+
+# A function that returns the counts for the minute a log message was written in, creating them if needed.
+# These per-minute counts are added to the rolling buckets that the mid and long time period figures are totalled from.
+def getMinuteBucket(logStats, logTimeUTC):
+
+    minute = logTimeUTC // 60000
+    minuteBucket = logStats["minuteBuckets"].get(minute)
+    if minuteBucket is None:
+        minuteBucket = logStats["minuteBuckets"][minute] = {"services": Counter(), "layers": Counter(), "timedLayers": Counter(), "layerDrawTimes": Counter()}
+    return minuteBucket
+
+
+# A function that adds one minute's counts to another's.
+def addToMinuteBucket(targetBucket, minuteBucket):
+
+    for key in ["services", "layers", "timedLayers", "layerDrawTimes"]:
+        for name, value in minuteBucket[key].items():
+            targetBucket[key][name] = targetBucket[key].get(name, 0) + value
+
+
+# A function that adds this run's per-minute counts to the rolling buckets kept in the state, and drops any buckets from before the long time period.
+def updateRollingBuckets(state, minuteBuckets, oldestMinute):
+
+    rollingBuckets = state.setdefault("minuteBuckets", {})
+
+    for minute, minuteBucket in minuteBuckets.items():
+        key = str(minute)
+        if key not in rollingBuckets:
+            rollingBuckets[key] = {"services": {}, "layers": {}, "timedLayers": {}, "layerDrawTimes": {}}
+        addToMinuteBucket(rollingBuckets[key], minuteBucket)
+
+    for key in list(rollingBuckets.keys()):
+        if int(key) <= oldestMinute:
+            del rollingBuckets[key]
+
+
+# A function that totals the rolling buckets for the minutes after the given minute.
+def sumRollingBuckets(state, afterMinute):
+
+    totals = {"services": Counter(), "layers": Counter(), "timedLayers": Counter(), "layerDrawTimes": Counter()}
+    for key, minuteBucket in state.get("minuteBuckets", {}).items():
+        if int(key) > afterMinute:
+            addToMinuteBucket(totals, minuteBucket)
+    return totals
+
+
+# A function that returns a layer's average draw time from totalled rolling buckets (or today's totals), or None if it has no timed draws.
+def averageRollingDrawTime(totals, layer):
+
+    timedLayers = totals["timedLayers"].get(layer, 0)
+    if timedLayers == 0:
+        return None
+    return 1.0 * totals["layerDrawTimes"].get(layer, 0) / timedLayers
+
+
+# A function that adds this run's counts to today's running totals kept in the state, starting them again when the UTC day changes.
+# The run is counted in the day of its stat date, like its row in the stats per time period layer. Returns today's totals.
+def updateTodayTotals(state, logStats, statDateUTC):
+
+    dateUTC = statDateUTC[:10] + " 00:00:00 AM"
+    todayTotals = state.get("todayTotals")
+    if todayTotals is None or todayTotals["dateUTC"] != dateUTC:
+        todayTotals = state["todayTotals"] = {"dateUTC": dateUTC, "servicesRequested": 0, "layersDrawn": 0, "timedDraws": 0, "totalDrawTime": 0, "errors": 0, "warnings": 0,
+                                              "services": {}, "layers": {}, "timedLayers": {}, "layerDrawTimes": {}}
+
+    for key in ["servicesRequested", "layersDrawn", "timedDraws", "totalDrawTime", "errors", "warnings"]:
+        todayTotals[key] += logStats[key]
+    for minuteBucket in logStats["minuteBuckets"].values():
+        addToMinuteBucket(todayTotals, minuteBucket)
+    return todayTotals
+
+
+# A function that keeps the rows of several summary layers up to date, given a list of (layer URL, rows, key fields, where clause, remove other rows).
+# Each row is identified by its key fields, e.g. the period and rank. Rows whose object id is known from an earlier run are updated in place and the
+# others are added, with their ids kept in summaryObjectIds for the next run. If a row's id isn't known (the first run, or the state was lost),
+# the rows already in the layer matching the where clause are looked up first, so a row is never added twice. The values written are totals
+# rather than changes, so a failed update is put right by the next run. Layers in the same feature service are written in one applyEdits request.
+def publishSummaries(summaryLayers, summaryObjectIds, portalSession):
+
+    serviceEdits = {}
+    for layerURL, rows, keyFields, whereClause, removeOtherRows in summaryLayers:
+        rowKey = lambda attributes, keyFields=keyFields: "|".join(unicode(attributes[field]) for field in keyFields)
+        objectIds = summaryObjectIds.get(layerURL, {})
+        duplicateIds = []
+
+        if any(rowKey(row) not in objectIds for row in rows):
+            existingRows = querySummaryRows(layerURL, whereClause, keyFields, portalSession)
+            if existingRows is None:
+                continue
+            for attributes in existingRows:
+                if objectIds.setdefault(rowKey(attributes), attributes["OBJECTID"]) != attributes["OBJECTID"]:
+                    duplicateIds.append(attributes["OBJECTID"])
+
+        layerEdits = {"rows": rows, "rowKey": rowKey, "adds": [], "updates": [], "deletes": []}
+        for row in rows:
+            if rowKey(row) in objectIds:
+                layerEdits["updates"].append({"attributes": dict(row, OBJECTID=objectIds[rowKey(row)])})
+            else:
+                layerEdits["adds"].append({"attributes": row})
+        if removeOtherRows:
+            rowKeys = set(rowKey(row) for row in rows)
+            layerEdits["deletes"] = [objectId for key, objectId in objectIds.items() if key not in rowKeys] + duplicateIds
+
+        # Only the ids of the rows still being kept up to date are needed next run
+        summaryObjectIds[layerURL] = dict((rowKey(row), objectIds[rowKey(row)]) for row in rows if rowKey(row) in objectIds)
+
+        serviceURL, _, layerId = layerURL.rstrip("/").rpartition("/")
+        serviceEdits.setdefault(serviceURL, {})[int(layerId)] = (layerURL, layerEdits)
+
+    for serviceURL, layers in serviceEdits.items():
+
+        # Set up the data to post
+        data = {
+            "f": "json",
+            "edits": json.dumps([{"id": layerId, "adds": layerEdits["adds"], "updates": layerEdits["updates"], "deletes": layerEdits["deletes"]}
+                                 for layerId, (layerURL, layerEdits) in layers.items()])
+        }
+
+        # Post data
+        try:
+            r = portalSession.post(serviceURL + '/applyEdits', data)
+            result = r.json()
+        except Exception as e:
+            log("Error posting summaries to applyEdits: " + str(e))
+            continue
+
+        if not isinstance(result, list):
+            log("Error returned by applyEdits for summaries " + r.text)
+            continue
+
+        # Keep the ids of the rows added, and forget the ids of rows that could not be updated (e.g. deleted by hand) so they are added again next run
+        for layerResult in result:
+            if layerResult.get("id") not in layers:
+                continue
+            layerURL, layerEdits = layers[layerResult["id"]]
+            objectIds = summaryObjectIds[layerURL]
+            for feature, addResult in zip(layerEdits["adds"], layerResult.get("addResults", [])):
+                if addResult.get("success"):
+                    objectIds[layerEdits["rowKey"](feature["attributes"])] = addResult["objectId"]
+            for feature, updateResult in zip(layerEdits["updates"], layerResult.get("updateResults", [])):
+                if not updateResult.get("success"):
+                    objectIds.pop(layerEdits["rowKey"](feature["attributes"]), None)
+
+        log("Updated summaries: " + ", ".join(layerURL + " (" + str(len(layerEdits["adds"])) + " added, " + str(len(layerEdits["updates"])) + " updated, " +
+                                              str(len(layerEdits["deletes"])) + " removed)" for layerURL, layerEdits in layers.values()))
+
+
+# A function that returns the object ids and key fields of the rows in a summary layer matching a where clause, or None if the query failed.
+def querySummaryRows(layerURL, whereClause, keyFields, portalSession):
+
+    # Set up the data to post
+    data = {
+        "f": "json",
+        "where": whereClause,
+        "outFields": ",".join(["OBJECTID"] + keyFields),
+        "returnGeometry": "false"
+    }
+
+    # Post data
+    try:
+        r = portalSession.post(layerURL + '/query', data)
+        result = r.json()
+    except Exception as e:
+        log("Error querying " + layerURL + ": " + str(e))
+        return None
+
+    if "error" in result:
+        log("Error returned by " + layerURL + " query " + r.text)
+        return None
+    return [feature["attributes"] for feature in result.get("features", [])]
+
+
+# A function that returns a hash identifying a log message, used to recognise messages already processed at the checkpoint.
+def logMessageHash(item):
+
+    key = u"|".join([unicode(item.get(field, "")) for field in ["time", "type", "code", "source", "machine", "process", "thread", "user", "message"]])
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+# A function that returns part of an error message for the log and error email - as UTF-8 bytes in Python 2, and as text in Python 3
+def errorText(value):
+
+    text = unicode(value)
+    return text.encode('utf-8') if str is bytes else text
+
 
 # A function that checks that the input JSON object is not an error object.    
 def assertJsonSuccess(data):
@@ -547,6 +1487,20 @@ def assertJsonSuccess(data):
     else:
         return True
 
+# A function that shows a message in the geoprocessing tool, if running as one
+def addMessage(message):
+
+    if arcpy:
+        arcpy.AddMessage(message)
+
+
+# A function that shows an error in the geoprocessing tool, if running as one
+def addError(message):
+
+    if arcpy:
+        arcpy.AddError(message)
+
+
 # Start of set logging function
 def setLogging(logFile):
 
@@ -575,7 +1529,7 @@ def setLogging(logFile):
 def sendEmail(message):
 
     # Send an email
-    arcpy.AddMessage("Sending email...")
+    addMessage("Sending email...")
 
     # Server and port information
     smtpServer = smtplib.SMTP(emailServerName, emailServerPort) 
@@ -596,6 +1550,40 @@ def sendEmail(message):
 # End of send email function
 
 
+# A function that keeps running, calling the main function every daemon interval. The admin connections, portal session and tokens
+# are kept between runs, so each run only does the work of fetching and posting the stats.
+def runDaemon(logFile, argv):
+
+    global logger, logMessage, keepSessions
+
+    keepSessions = "true"
+    while True:
+        runStartTime = time.time()
+
+        # The main function logs and emails its own errors, so anything that gets out of it (e.g. the error email failing) is only
+        # logged, and the next run goes ahead as usual
+        try:
+            mainFunction(*argv)
+        except (Exception, SystemExit) as e:
+            if loggingEnabled:
+                logger.exception("Run failed: " + str(e))
+
+        # Close the log file if the run has not already, so each run is logged the same way as a scheduled run
+        if loggingEnabled:
+            for handler in list(logger.handlers):
+                handler.close()
+                logger.removeHandler(handler)
+
+        # Wait until the next run is due, skipping any runs missed while this one was running
+        waitTime = (daemonInterval * 60) - ((time.time() - runStartTime) % (daemonInterval * 60))
+        time.sleep(waitTime)
+
+        if loggingEnabled:
+            logger, logMessage = setLogging(logFile)
+            logger.info("***************")
+            logger.info("Process started")
+
+
 # This test allows the script to be used from the operating
 # system command prompt (stand-alone), in a Python IDE, 
 # as a geoprocessing script tool, or as a module imported in
@@ -603,8 +1591,15 @@ def sendEmail(message):
 if __name__ == '__main__':
 
     # Arguments are optional - If running from ArcGIS Desktop tool, parameters will be loaded into *argv
-    argv = tuple(arcpy.GetParameterAsText(i)
-        for i in range(arcpy.GetArgumentCount()))
+    if runningAsTool():
+        loadArcpy(globals())
+
+        # Enable data to be overwritten
+        arcpy.env.overwriteOutput = True
+        argv = tuple(arcpy.GetParameterAsText(i)
+            for i in range(arcpy.GetArgumentCount()))
+    else:
+        argv = tuple(sys.argv[1:])
 
     logFilename = argv[0]
     logFile = os.path.join(os.path.dirname(__file__), "Logs", logFilename)
@@ -630,4 +1625,7 @@ if __name__ == '__main__':
         # Install the proxy
         urllib2.install_opener(openURL)
 
-    mainFunction(*argv)
+    if runAsDaemon == "true":
+        runDaemon(logFile, argv)
+    else:
+        mainFunction(*argv)
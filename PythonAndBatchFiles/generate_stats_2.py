@@ -12,15 +12,22 @@ import os
 import sys
 import logging
 import smtplib
-import arcpy
 import datetime
 import requests
 import json
-from requests_ntlm import HttpNtlmAuth
+import threading
 import time
 from calendar import timegm
-from collections import Counter
-from arcgis.gis import GIS
+from multiprocessing.pool import ThreadPool
+from outbox import Outbox, flushOutbox
+from stats_common import PortalSession, tokenExpiring, tokenExpiryTime, recordStage, stageTimingsSummary, loadState, saveState, runningAsTool, loadArcpy
+
+# arcpy is only imported when running as a geoprocessing tool (see loadArcpy), as importing it is slow and checks out a licence
+arcpy = None
+
+# Stands in for arcpy.ExecuteError until arcpy is imported, so the error handling in the main function works either way
+class ArcpyExecuteError(Exception):
+    pass
 
 # Set global variables
 
@@ -43,6 +50,28 @@ requestProtocol = "http" # http or https
 proxyURL = ""
 output = None
 
+# Service status
+statusCheckThreads = 16 # Most service status requests made to ArcGIS Server at the same time
+adminRequestTimeout = 30 # Seconds to wait for each ArcGIS Server admin request. A service whose status request fails or times out is counted as unknown.
+unknownState = "UNKNOWN" # State recorded for a service whose status could not be found
+serviceNotFound = "NOTFOUND" # State recorded for a service that is no longer on the server, which means the cached list of services is out of date
+stateFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "State") # Folder holding a state file for each log filename, with the last known state of each service
+inventoryTTL = 60 # Minutes the list of folders and services on the server is kept in the state file and reused, rather than listed again every run (0 = list them every run)
+
+# Publishing
+outboxFlushSeconds = 60 # Most seconds spent sending the outbox to the portal each run. Features not sent by then wait in the outbox for the next run
+portalRequestTimeout = 60 # Seconds to wait when connecting to or reading from the portal
+
+# Daemon
+runAsDaemon = "false" # Keep running and check the services every daemon interval, rather than being started by a scheduled task for each run
+daemonInterval = 5 # Minutes between runs when running as a daemon
+tokenExpiration = 60 # Minutes the admin and portal tokens are requested for
+tokenRefreshMargin = 5 # Tokens are generated again when they are this many minutes from expiring
+keepSessions = "false" # Keep sessions and tokens in warmSessions for later runs. Set when running as a daemon, and by run_all_stats.py to share them between sites
+warmSessions = {} # Admin and portal sessions and their tokens kept between runs when running as a daemon
+warmSessionsLock = threading.Lock()
+stageTimings = {} # Seconds taken by each stage of the last run for each log filename, e.g. for run_all_stats.py to report
+
 def log(message):
     if loggingEnabled:
         logger.info(message)
@@ -60,186 +89,231 @@ def mainFunction(logFilename,
                  domainPassword,
                  tokenURL,
                  fcStatsServicesStatus,
-                 fcStatsServucesDown):
+                 fcStatsServucesDown,
+                 fcStatsServicesStatusLatest="",
+                 fcStatsServiceChanges=""):
 
     # --------------------------------------- Start of code --------------------------------------- #
 
     try:
+        # Time each stage of the run
+        stageTimings[logFilename] = []
+        stageStartTime = time.time()
+
         # Parameter conversions
         currentDateTimeUTCRaw = datetime.datetime.utcnow()
         statDateUTC = currentDateTimeUTCRaw.strftime("%Y-%m-%d %H:%M:00 %p") # "2020-01-10 10:00:00 AM" format. Rounds down to the nearest minute.
+        statDateMs = timegm(time.strptime(statDateUTC, "%Y-%m-%d %H:%M:%S %p")) * 1000
+
+        # The last known state of each service, and the list of services on the server if it has been listed recently
+        stateFile = os.path.join(stateFolder, os.path.splitext(logFilename)[0] + ".json")
+        state = loadState(stateFile)
 
         services = []
+        serviceStates = [] # Path (folder/name.type), configured state and real time state of each service
         servicesUp = []
         servicesDown = []
+        servicesUnknown = []
+        inventoryComplete = True # Whether every folder was listed, so a service missing from the list has been deleted
 
         if 'intgis' in serverURL:
 
             ### Find status of each service ###
-            gis = GIS(serverURL, portalUsername, portalPassword)
-            gis_servers = gis.admin.servers.list()
-            server1 = gis_servers[0]
-
-            # Get list of folders on server
-            folders = server1.services.folders
-
-            # Get list of all services in all folders
-            for folder in folders:
-                services += server1.services.list(folder=folder)
-            
-            log('Total services: ' + str(len(services)))
-
-            # Find out which services (which should be running) are up/down
-            for service in services:
-
-                serviceName = service.properties["serviceName"]
-                serviceConfiguredState = service.status["configuredState"]
-                serviceRealTimeState = service.status["realTimeState"]
-
-                if serviceConfiguredState == "STARTED":
-                    if serviceRealTimeState == "STARTED":
-                        servicesUp.append(serviceName)
-                    else:
-                        servicesDown.append({
-                            "attributes" : {
-                                "StatDateUTC": statDateUTC,
-                                "Service": serviceName}
-                            })
 
-        elif 'publicgis' in serverURL:
+            # Sign in to the portal and get the server, or reuse them from the last run if running as a daemon
+            serverHandle = getServerHandle(serverURL, portalUsername, portalPassword)
 
-            rawServerURL = "http://" + serverHostname + ":" + serverPort
+            try:
+                # Use the services listed by an earlier run, unless the list has expired
+                if serverHandle["services"] is None or time.time() - serverHandle["listedTime"] >= inventoryTTL * 60:
+                    server1 = serverHandle["server"]
+
+                    # Get list of folders on server
+                    folders = server1.services.folders
 
-            # Get a token
-            token = getToken(rawServerURL, serverUsername, serverPassword)
+                    # Get list of all services in all folders, with the folder each is in
+                    services = []
+                    for folder in folders:
+                        services += [(folder, service) for service in server1.services.list(folder=folder)]
 
-            # Fetch list of folders on server            
-            servicesURL = rawServerURL + '/arcgis/admin/services'
-            params = {'token': token, 'f': 'json'}
-            resp = requests.post(servicesURL, data=params)
+                    serverHandle["services"] = services
+                    serverHandle["listedTime"] = time.time()
 
-            if resp.status_code != 200:
-                log("Error while getting list of folders on server")
-                sys.exit()
+                services = serverHandle["services"]
+                log('Total services: ' + str(len(services)))
 
-            folders = [''] + resp.json()['folders']
-            # log(str(folders))
+                # Find the status of each service, making a number of requests at the same time. The service properties are only fetched the first time.
+                statusPool = ThreadPool(min(statusCheckThreads, max(len(services), 1)))
+                serviceStates = statusPool.map(getServiceStatusFromAPI, services)
+                statusPool.close()
+            except Exception:
+                # The sign in may have expired, so sign in again next run
+                dropServerHandle(serverURL, portalUsername)
+                raise
 
-            # Get list of all services in all folders
-            services = []
-            for folder in folders:
+            # A service may have been deleted since the services were listed, so list them again next run
+            if unknownState in [serviceConfiguredState for serviceName, serviceConfiguredState, serviceRealTimeState in serviceStates]:
+                serverHandle["services"] = None
 
-                folderURL = rawServerURL + "/arcgis/admin/services/" + folder
-                params = {'token': token, 'f': 'json'}
-                resp = requests.post(folderURL, data=params)
-                
-                if resp.status_code != 200:
-                    log("Error while getting list of services in folder '" + folder + "'")
-                    sys.exit()
+        elif 'publicgis' in serverURL:
+
+            rawServerURL = "http://" + serverHostname + ":" + serverPort
+
+            # Get a keep-alive session and token for the admin requests, or reuse them from the last run if running as a daemon
+            adminSession, token = getAdminSession(rawServerURL, serverUsername, serverPassword)
 
-                servicesInFolder = resp.json()['services']
+            # Use the list of services from the state file, unless it has expired
+            inventory = state.get("inventory")
+            if inventory is not None and statDateMs - inventory["listedUTC"] < inventoryTTL * 60 * 1000:
+                services = inventory["services"]
+                log('Total services: ' + str(len(services)) + ' (listed at ' + str(inventory["listedUTC"]) + ')')
+                serviceStates = getServiceStatuses(adminSession, token, rawServerURL, services)
 
-                # Loop through each service in the folder and find its status
-                for service in servicesInFolder:
+                # A service has been deleted or moved since the list was made, so list the services again
+                if serviceNotFound in [serviceConfiguredState for serviceName, serviceConfiguredState, serviceRealTimeState in serviceStates]:
+                    log("Services have changed since they were listed, listing them again")
+                    inventory = None
+            else:
+                inventory = None
 
-                    serviceName = service['serviceName'] + "." + service['type']
+            if inventory is None:
+                services = listServices(adminSession, token, rawServerURL)
 
-                    # Construct URL to stop or start service, then make the request                
-                    if folder == "":
-                        statusURL = rawServerURL + "/arcgis/admin/services/" + serviceName + "/status"
-                    else:
-                        statusURL = rawServerURL + "/arcgis/admin/services/" + folder + "/" + serviceName + "/status"
+                if services is None:
+                    log("Error while getting list of folders on server")
+                    return
 
-                    # log(statusURL)
-                    resp = requests.post(statusURL, data=params)
+                # Only keep the list if every folder could be listed
+                inventoryComplete = None not in services
+                services = [service for service in services if service is not None]
+                if inventoryComplete:
+                    state["inventory"] = {"listedUTC": statDateMs, "services": services}
+                else:
+                    state.pop("inventory", None)
 
-                    if resp.status_code != 200:
-                        log("Error while getting status of service '" + serviceName + "'")
-                        sys.exit()
+                log('Total services: ' + str(len(services)))
+                serviceStates = getServiceStatuses(adminSession, token, rawServerURL, services)
 
-                    serviceConfiguredState = resp.json()['configuredState']
-                    serviceRealTimeState = resp.json()['realTimeState']
+        # Find out which services (which should be running) are up/down
+        for serviceName, serviceConfiguredState, serviceRealTimeState in serviceStates:
 
-                    if serviceConfiguredState == "STARTED":
-                        if serviceRealTimeState == "STARTED":
-                            servicesUp.append(serviceName)
-                        else:
-                            servicesDown.append({
-                                "attributes" : {
-                                    "StatDateUTC": statDateUTC,
-                                    "Service": serviceName}
-                                })
+            if serviceConfiguredState in (unknownState, serviceNotFound):
+                servicesUnknown.append(serviceName)
+            elif serviceConfiguredState == "STARTED":
+                if serviceRealTimeState == "STARTED":
+                    servicesUp.append(serviceName)
+                else:
+                    servicesDown.append(serviceName)
 
         log("Services up: " + str(len(servicesUp)))
         log("Services down: " + str(len(servicesDown)))
+        if servicesUnknown:
+            log("Services unknown: " + str(len(servicesUnknown)) + " " + str(servicesUnknown))
         log("Services down list: " + str(servicesDown))
 
+        # Compare each service with its last known state, so only the services which have gone down or come back are written and emailed about
+        newOutages, endedOutages, configuredStateChanges = findServiceChanges(state.setdefault("services", {}), serviceStates, statDateMs, inventoryComplete)
+        log("Services gone down: " + str(newOutages))
+        log("Services come back: " + str([serviceName for serviceName, outage in endedOutages]))
+        for serviceName, previousState, configuredState in configuredStateChanges:
+            log("Service '" + serviceName + "' configured state changed from " + previousState + " to " + configuredState)
+        stageStartTime = recordStage(stageTimings[logFilename], "Service status", stageStartTime)
+
         ##########################################################
         ### Post time-based data to ArcGIS Stats Feature Class ###
         ##########################################################
 
-        # Generate portal token
-        r = requests.post(tokenURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data = {"f": "json"})
-        token = r.json()['token']
+        # Set up the session used for all requests to the portal, which generates the portal token, or reuse it from the last run if running as a daemon
+        portalSession = getPortalSession(tokenURL, domainUsername, domainPassword)
 
-        ### Services Status ###
+        # The features are saved to the outbox along with the state, so the status and outages found this run can't be lost if the portal is
+        # down or slow. They are removed from the outbox once they have been sent.
+        outbox = Outbox(os.path.join(stateFolder, os.path.splitext(logFilename)[0] + "_outbox.db"))
+        outboxEdits = []
 
-        # Set up feature service URL
-        featureService = fcStatsServicesStatus
-        addFeaturesURL = featureService + '/addFeatures'
+        ### Services Status ###
 
-        # Set up the data to post
-        data = {
-            "f": "json",
-            "token": token,
-            "features": json.dumps([{
-                "attributes" : {
-                    "StatDateUTC" : statDateUTC,
-                    "ServicesUp" : len(servicesUp),
-                    "ServicesDown": len(servicesDown),
-                    "TotalServices": len(services)
-                }
-            }])
+        servicesStatus = {
+            "StatDateUTC" : statDateUTC,
+            "ServicesUp" : len(servicesUp),
+            "ServicesDown": len(servicesDown),
+            "ServicesUnknown": len(servicesUnknown),
+            "TotalServices": len(services)
         }
 
-        # Post data
-        headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-        r = requests.post(url=addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
-
-        log(r.text)
+        outboxEdits.append((fcStatsServicesStatus, "add", None, [{"attributes": servicesStatus}]))
 
         ### Services Down ###
 
-        if len(servicesDown):
+        # Each outage is one row, added when the service goes down and updated with when it came back
+        if len(newOutages):
+
+            # Send email
+            if sendErrorEmail == "true":
+                sendEmail("Service(s) down on " + serverURL, str(newOutages))
+
+            outboxEdits.append((fcStatsServucesDown, "add", None, [{
+                "attributes" : {
+                    "StatDateUTC": statDateUTC,
+                    "Service": serviceName,
+                    "ConfiguredState": state["services"][serviceName]["configuredState"]}
+                } for serviceName in newOutages]))
+
+        if len(endedOutages):
 
             # Send email
-            if sendErrorEmail:
-                sendEmail("Service(s) down on " + serverURL, str(servicesDown))
+            if sendErrorEmail == "true":
+                sendEmail("Service(s) back up on " + serverURL, str([serviceName for serviceName, outage in endedOutages]))
+
+        # The row of an outage is the service's row that hasn't been given an up date yet
+        for serviceName, outage in endedOutages:
+            outboxEdits.append((fcStatsServucesDown, "update", "Service = '" + serviceName.replace("'", "''") + "' AND UpDateUTC IS NULL", [{
+                "UpDateUTC": statDateUTC,
+                "OutageMinutes": (statDateMs - outage["downSinceUTC"]) / 60000.0,
+                "ConfiguredState": outage["configuredState"]}]))
+
+        ### Service Changes ###
+
+        # A row for each service whose configured state has changed since the last run, e.g. stopped on purpose or started again
+        if fcStatsServiceChanges and len(configuredStateChanges):
+            outboxEdits.append((fcStatsServiceChanges, "add", None, [{
+                "attributes" : {
+                    "StatDateUTC": statDateUTC,
+                    "Service": serviceName,
+                    "PreviousState": previousState,
+                    "ConfiguredState": configuredState}
+                } for serviceName, previousState, configuredState in configuredStateChanges]))
 
-            # Set up feature service URL
-            featureService = fcStatsServucesDown
-            addFeaturesURL = featureService + '/addFeatures'
+        outbox.add(outboxEdits)
+        saveState(stateFile, state)
 
-            # Set up the data to post
-            data = {
-                "f": "json",
-                "token": token,
-                "features": json.dumps(servicesDown)
-            }
+        # Post data - this run's features, and any left in the outbox by earlier runs
+        outboxSent = flushOutbox(outbox, portalSession, log, outboxFlushSeconds)
 
-            # Post data
-            headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-            r = requests.post(url=addFeaturesURL, auth=HttpNtlmAuth(domainUsername, domainPassword), data=data, headers=headers)
+        ### Latest Services Status ###
 
-            log(r.text)
+        # One row with the latest status, updated in place each run, so the dashboard's indicators read it rather than the row for every run.
+        # It is not sent through the outbox, as a later run's status replaces it. If the outbox couldn't be sent, the next run updates it.
+        if fcStatsServicesStatusLatest and not outboxSent:
+            log("The outbox was not sent in full, so the latest services status will be updated next run")
+        elif fcStatsServicesStatusLatest:
+            try:
+                publishLatestStatus(fcStatsServicesStatusLatest, servicesStatus, state, portalSession)
+                saveState(stateFile, state)
+            except Exception as e:
+                log("Error updating the latest services status: " + str(e))
+
+        log(portalSession.summary())
+        recordStage(stageTimings[logFilename], "Publish", stageStartTime)
+        log("Stage timings: " + stageTimingsSummary(stageTimings[logFilename]))
 
 
     # If arcpy error
-    except arcpy.ExecuteError:           
+    except ArcpyExecuteError:           
 
         # Build and show the error message
         errorMessage = arcpy.GetMessages(2)   
-        arcpy.AddError(errorMessage)           
+        addError(errorMessage)           
 
         # Logging
         if loggingEnabled:
@@ -269,16 +343,16 @@ def mainFunction(logFilename,
 
             if (i == 0):
                 try:
-                    errorMessage = unicode(e.args[i]).encode('utf-8')
+                    errorMessage = str(e.args[i])
                 except Exception:
                     errorMessage = 'Unable to encode error message component'
             else:
                 try:
-                    errorMessage = errorMessage + " " + unicode(e.args[i]).encode('utf-8')
+                    errorMessage = errorMessage + " " + str(e.args[i])
                 except Exception:
                     errorMessage = 'Unable to encode error message component'
 
-        arcpy.AddError(errorMessage)              
+        addError(errorMessage)              
 
         # Logging
         if loggingEnabled:
@@ -301,21 +375,307 @@ def mainFunction(logFilename,
 # End of main function
 
 
-# A function to generate a token given username, password and the adminURL.
-def getToken(rawServerURL, username, password):
+# A function to generate a token given username, password, the adminURL and the session to request it on.
+def getToken(rawServerURL, username, password, adminSession=requests):
 
     tokenURL = rawServerURL + "/arcgis/admin/generateToken"
-    params = {'username': username, 'password': password, 'client': 'requestip', 'f': 'json'}
-    resp = requests.post(tokenURL, data=params)
+    params = {'username': username, 'password': password, 'client': 'requestip', 'expiration': tokenExpiration, 'f': 'json'}
+    resp = adminSession.post(tokenURL, data=params, timeout=adminRequestTimeout)
 
     if resp.status_code != 200:
-        log("Error while fetching tokens from admin URL. Please check the URL and try again.")
-        sys.exit()
+        raise Exception("Error while fetching tokens from admin URL. Please check the URL and try again.")
+
+    # Extract the token and when it expires
+    tokenInfo = resp.json()
+    return tokenInfo['token'], tokenExpiryTime(tokenInfo, tokenExpiration)
+
+
+# A function that updates the last known state of each service, and returns the services which have gone down since the last run,
+# the outages which have ended - because the service came back, was stopped on purpose or was deleted - and the services whose
+# configured state has changed, as (service, previous state, configured state). A service whose status
+# is unknown keeps its last known state.
+def findServiceChanges(knownServices, serviceStates, statDateMs, inventoryComplete):
+
+    newOutages = []
+    endedOutages = []
+    configuredStateChanges = []
+    servicesFound = set()
+
+    for serviceName, serviceConfiguredState, serviceRealTimeState in serviceStates:
+        servicesFound.add(serviceName)
+        if serviceConfiguredState in (unknownState, serviceNotFound):
+            continue
+
+        # The last known state of a service is its configured and real time states, and when it went down if it is down
+        known = knownServices.get(serviceName)
+        if known is None:
+            known = knownServices[serviceName] = {"configuredState": serviceConfiguredState, "realTimeState": serviceRealTimeState, "downSinceUTC": None}
+        elif known["configuredState"] != serviceConfiguredState:
+            configuredStateChanges.append((serviceName, known["configuredState"], serviceConfiguredState))
+        known["configuredState"] = serviceConfiguredState
+        known["realTimeState"] = serviceRealTimeState
+
+        down = serviceConfiguredState == "STARTED" and serviceRealTimeState != "STARTED"
+        if down and known["downSinceUTC"] is None:
+            known["downSinceUTC"] = statDateMs
+            newOutages.append(serviceName)
+        elif not down and known["downSinceUTC"] is not None:
+            endedOutages.append((serviceName, dict(known)))
+            known["downSinceUTC"] = None
+
+    # Services which are no longer on the server. If a folder could not be listed its services may just be missing from the list, so they are kept.
+    if inventoryComplete:
+        for serviceName in list(knownServices):
+            if serviceName not in servicesFound:
+                known = knownServices.pop(serviceName)
+                if known["downSinceUTC"] is not None:
+                    known["configuredState"] = "DELETED"
+                    endedOutages.append((serviceName, known))
+
+    return newOutages, endedOutages, configuredStateChanges
+
+
+# A function that writes the latest services status to the single row of the latest status layer. The row's id is kept in the state,
+# or found in the layer if it isn't known (the first run, or the state was lost), and the row is added again if it can't be updated.
+def publishLatestStatus(featureService, servicesStatus, state, portalSession):
+
+    objectId = state.get("latestStatusObjectId")
+    if objectId is None:
+        # Set up the data to post
+        data = {
+            "f": "json",
+            "where": "1=1",
+            "returnIdsOnly": "true"
+        }
+
+        # Post data
+        r = portalSession.post(featureService + '/query', data)
+        objectId = min(r.json().get("objectIds") or [None])
+
+    if objectId is not None:
+        # Set up the data to post
+        data = {
+            "f": "json",
+            "features": json.dumps([{"attributes": dict(servicesStatus, OBJECTID=objectId)}])
+        }
+
+        # Post data
+        r = portalSession.post(featureService + '/updateFeatures', data)
+
+        log(r.text)
+        if all(updateResult.get("success") for updateResult in r.json().get("updateResults", [{}])):
+            state["latestStatusObjectId"] = objectId
+            return
+
+    # Set up the data to post
+    data = {
+        "f": "json",
+        "features": json.dumps([{"attributes": servicesStatus}])
+    }
+
+    # Post data
+    r = portalSession.post(featureService + '/addFeatures', data)
+
+    log(r.text)
+    addResults = r.json().get("addResults", [])
+    state["latestStatusObjectId"] = addResults[0]["objectId"] if addResults and addResults[0].get("success") else None
+
+
+# A function that makes a request to the ArcGIS Server admin API and returns the JSON response, or None if the request fails, times out or returns an error
+# (unless returnErrors is set, in which case the error response is returned)
+def adminRequest(adminSession, url, token, returnErrors=False):
+
+    try:
+        resp = adminSession.post(url, data={'token': token, 'f': 'json'}, timeout=adminRequestTimeout)
+        if resp.status_code != 200:
+            log(url + " returned HTTP status " + str(resp.status_code))
+            return None
+        result = resp.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        log(url + " failed: " + str(e))
+        return None
+
+    if result.get("status") == "error":
+        log(url + " returned an error: " + str(result.get("messages")))
+        return result if returnErrors else None
+    return result
+
+
+# A function that signs in to the portal with the ArcGIS API and returns it with the first server, reusing them from the last run when running as a daemon
+# (or from another site when run from run_all_stats.py). The services listed on the server are kept with them.
+def getServerHandle(serverURL, portalUsername, portalPassword):
+
+    key = ("gis", serverURL, portalUsername)
+    with warmSessionsLock:
+        serverHandle = warmSessions.get(key)
+    if serverHandle is not None:
+        return serverHandle
+
+    # Signing in takes a few seconds, so it is done without holding up the other sites getting their sessions
+    from arcgis.gis import GIS # Only imported here, as it is slow to import and is not needed for publicgis
+    gis = GIS(serverURL, portalUsername, portalPassword)
+    serverHandle = {"gis": gis, "server": gis.admin.servers.list()[0], "services": None, "listedTime": 0}
+    if keepSessions == "true":
+        with warmSessionsLock:
+            serverHandle = warmSessions.setdefault(key, serverHandle)
+
+    return serverHandle
+
+
+# A function that forgets the portal sign in for a server, so the next run signs in again
+def dropServerHandle(serverURL, portalUsername):
+
+    with warmSessionsLock:
+        warmSessions.pop(("gis", serverURL, portalUsername), None)
+
+
+# A function that returns the path, configured state and real time state of a service in a folder from the ArcGIS API. If its status cannot be found, both states are unknown.
+def getServiceStatusFromAPI(folderService):
+
+    folder, service = folderService
+    try:
+        serviceName = servicePath(folder, service.properties["serviceName"] + "." + service.properties["type"])
+    except Exception as e:
+        log("Error while getting properties of service: " + str(e))
+        return servicePath(folder, str(service)), unknownState, unknownState
+
+    try:
+        status = service.status
+        return serviceName, status["configuredState"], status["realTimeState"]
+    except Exception as e:
+        log("Error while getting status of service '" + serviceName + "': " + str(e))
+        return serviceName, unknownState, unknownState
+
+
+# A function that lists the services in every folder on the server, as [folder, service name] pairs. A folder that could not be listed
+# adds None to the list, so the list is not kept. Returns None if the folders could not be listed.
+def listServices(adminSession, token, rawServerURL):
+
+    # Fetch list of folders on server            
+    servicesURL = rawServerURL + '/arcgis/admin/services'
+    folderList = adminRequest(adminSession, servicesURL, token)
+
+    if folderList is None:
+        return None
+
+    folders = [''] + folderList['folders']
+    # log(str(folders))
+
+    # Get list of all services in all folders
+    services = []
+    for folder in folders:
+
+        folderInfo = adminRequest(adminSession, servicesURL + "/" + folder, token)
+
+        if folderInfo is None:
+            log("Error while getting list of services in folder '" + folder + "'")
+            services.append(None)
+            continue
+
+        for service in folderInfo['services']:
+            services.append([folder, service['serviceName'] + "." + service['type']])
+
+    return services
+
+
+# A function that finds the status of each service, making a number of requests at the same time
+def getServiceStatuses(adminSession, token, rawServerURL, services):
+
+    statusPool = ThreadPool(min(statusCheckThreads, max(len(services), 1)))
+    serviceStates = statusPool.map(lambda service: getServiceStatus(adminSession, token, rawServerURL, service[0], service[1]), services)
+    statusPool.close()
+    return serviceStates
+
+
+# A function that clears the list of services kept in the state file for a log filename, so the next run lists them again
+def invalidateInventory(logFilename):
+
+    stateFile = os.path.join(stateFolder, os.path.splitext(logFilename)[0] + ".json")
+    state = loadState(stateFile)
+    if state.pop("inventory", None) is not None:
+        saveState(stateFile, state)
+
+
+# A function that returns the path, configured state and real time state of a service. If its status cannot be found, both states are unknown, so one service does not stop the whole run.
+# If the service is not on the server any more, both states are not found.
+def getServiceStatus(adminSession, token, rawServerURL, folder, serviceName):
+
+    # Construct URL to get the status of the service, then make the request
+    serviceName = servicePath(folder, serviceName)
+    statusURL = rawServerURL + "/arcgis/admin/services/" + serviceName + "/status"
+
+    status = adminRequest(adminSession, statusURL, token, returnErrors=True)
+
+    if status is not None and status.get("code") == 404:
+        return serviceName, serviceNotFound, serviceNotFound
+
+    if status is None or "configuredState" not in status:
+        log("Error while getting status of service '" + serviceName + "'")
+        return serviceName, unknownState, unknownState
+
+    return serviceName, status["configuredState"], status.get("realTimeState", unknownState)
+
+
+# A function that returns the path of a service, e.g. "Public/Roads.MapServer". Services with the same name in different folders are different
+# services, so they are told apart by their path rather than their name. Services in the root folder have no folder in their path.
+def servicePath(folder, serviceName):
+
+    if folder in ("", "/"):
+        return serviceName
+    return folder + "/" + serviceName
+
+
+# A function that returns a keep-alive session and token for the ArcGIS Server admin requests, reusing them from the last run when running as a daemon (or from another site when run from run_all_stats.py).
+# A new token is only generated when the current one is about to expire.
+def getAdminSession(rawServerURL, serverUsername, serverPassword):
+
+    key = ("admin", rawServerURL, serverUsername)
+    with warmSessionsLock:
+        adminSession = warmSessions.get(key)
+        if adminSession is None:
+            adminSession = {"session": requests.Session(), "token": None, "tokenExpires": 0}
+
+            # Keep a connection open for each of the status requests made at the same time
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=statusCheckThreads)
+            adminSession["session"].mount("http://", adapter)
+            adminSession["session"].mount("https://", adapter)
+            if keepSessions == "true":
+                warmSessions[key] = adminSession
+
+        if adminSession["token"] is None or tokenExpiring(adminSession["tokenExpires"], tokenRefreshMargin):
+            adminSession["token"], adminSession["tokenExpires"] = getToken(rawServerURL, serverUsername, serverPassword, adminSession["session"])
+
+    return adminSession["session"], adminSession["token"]
+
+
+# A function that returns the portal session for a portal and user, reusing it from the last run when running as a daemon (or from another site when run from run_all_stats.py)
+def getPortalSession(tokenURL, domainUsername, domainPassword):
+
+    key = ("portal", tokenURL, domainUsername)
+    with warmSessionsLock:
+        portalSession = warmSessions.get(key)
+        if portalSession is None:
+            portalSession = PortalSession(tokenURL, domainUsername, domainPassword, tokenExpiration, tokenRefreshMargin, portalRequestTimeout)
+            if keepSessions == "true":
+                warmSessions[key] = portalSession
+
+    # Count this run's requests on their own, as other sites may be using the session at the same time
+    return portalSession.forRun()
+
+
+# A function that shows a message in the geoprocessing tool, if running as one
+def addMessage(message):
+
+    if arcpy:
+        arcpy.AddMessage(message)
+
+
+# A function that shows an error in the geoprocessing tool, if running as one
+def addError(message):
+
+    if arcpy:
+        arcpy.AddError(message)
 
-    # Extract the token
-    token = resp.json()['token']       
-    return token       
-        
 
 # Start of set logging function
 def setLogging(logFile):
@@ -345,7 +705,7 @@ def setLogging(logFile):
 def sendEmail(emailSubject, emailMessage):
 
     # Send an email
-    arcpy.AddMessage("Sending email...")
+    addMessage("Sending email...")
     log("Sending email...")
 
     # Server and port information
@@ -367,6 +727,44 @@ def sendEmail(emailSubject, emailMessage):
 # End of send email function
 
 
+# A function that keeps running, calling the main function every daemon interval. The admin and portal sessions and their tokens
+# are kept between runs, so each run only does the work of checking the services and posting the stats.
+def runDaemon(logFile, argv):
+
+    global logger, logMessage, keepSessions
+
+    keepSessions = "true"
+    while True:
+        runStartTime = time.time()
+
+        # A failed run (e.g. the portal or server could not be reached) is logged and emailed, and the next run goes ahead as usual
+        try:
+            mainFunction(*argv)
+        except (Exception, SystemExit) as e:
+            if loggingEnabled:
+                logger.exception("Run failed: " + str(e))
+            if sendErrorEmail == "true":
+                try:
+                    sendEmail(emailSubject, emailMessage + '\n' + '\n' + str(e))
+                except Exception as emailError:
+                    log("Could not send the error email: " + str(emailError))
+
+        # Close the log file if the run has not already, so each run is logged the same way as a scheduled run
+        if loggingEnabled:
+            for handler in list(logger.handlers):
+                handler.close()
+                logger.removeHandler(handler)
+
+        # Wait until the next run is due, skipping any runs missed while this one was running
+        waitTime = (daemonInterval * 60) - ((time.time() - runStartTime) % (daemonInterval * 60))
+        time.sleep(waitTime)
+
+        if loggingEnabled:
+            logger, logMessage = setLogging(logFile)
+            logger.info("***************")
+            logger.info("Process started")
+
+
 # This test allows the script to be used from the operating
 # system command prompt (stand-alone), in a Python IDE, 
 # as a geoprocessing script tool, or as a module imported in
@@ -374,8 +772,18 @@ def sendEmail(emailSubject, emailMessage):
 if __name__ == '__main__':
 
     # Arguments are optional - If running from ArcGIS Desktop tool, parameters will be loaded into *argv
-    argv = tuple(arcpy.GetParameterAsText(i)
-        for i in range(arcpy.GetArgumentCount()))
+    if runningAsTool():
+        loadArcpy(globals())
+        argv = tuple(arcpy.GetParameterAsText(i)
+            for i in range(arcpy.GetArgumentCount()))
+    else:
+        argv = tuple(sys.argv[1:])
+
+    # Clear the list of services kept in the state file, e.g. after adding services, so the next run lists them again:
+    #   python generate_stats_2.py --refresh-inventory <log filename>
+    if argv and argv[0] == "--refresh-inventory":
+        invalidateInventory(argv[1])
+        sys.exit()
 
     logFilename = argv[0]
     logFile = os.path.join(os.path.dirname(__file__), "Logs", logFilename)
@@ -391,5 +799,8 @@ if __name__ == '__main__':
         logger.info("***************")
         logger.info("Process started")
 
-    mainFunction(*argv)
+    if runAsDaemon == "true":
+        runDaemon(logFile, argv)
+    else:
+        mainFunction(*argv)
 
@@ -0,0 +1,363 @@
+#-------------------------------------------------------------
+# Name:       ArcGIS Stats outbox
+# Purpose:    A local SQLite outbox for the features the stats scripts write to the stats feature services. A run saves its features
+#             to the outbox before anything is sent to the portal, and the outbox is then sent in batches. If the portal is down or
+#             slow the features wait in the outbox and are sent by a later run, so a run's stats are delayed rather than lost.
+# Author:     Keith Miller (keith.miller@kapiticoast.govt.nz)
+# Date Created:    18/10/2026
+# Copyright:   (c) Kapiti Coast District Council, Eagle Technologies
+# ArcGIS Version:   10.0+
+# Python Version:   2.7 / 3.6+
+#--------------------------------
+
+# Import modules
+import os
+import json
+import time
+import uuid
+import sqlite3
+
+# Set global variables
+retryDelay = 60 # Seconds before an edit that could not be sent is tried again. The delay doubles after each failure, up to maxRetryDelay
+maxRetryDelay = 60 * 60 # Most seconds between tries
+sendingTimeout = 10 * 60 # Seconds an edit is held by the run sending it. If that run stops before it finishes, a later run sends the edit after this
+maxAttempts = 50 # Tries before an edit is given up on (about two days at maxRetryDelay) and moved to the failedEdits table, so it doesn't hold up the edits after it
+
+
+# A queue of edits to the stats feature services, kept in a SQLite database. Each edit is either features to add to a layer, or attributes
+# to update on the rows of a layer matching a where clause. Each add writes its own edit ID to the EditID field of the rows it adds, so if
+# it has to be sent again after a try whose result isn't known, just those rows are removed first rather than added twice.
+# Edits that still can't be sent after maxAttempts tries are moved to the failedEdits table, where they are kept to be looked at. The outbox
+# also keeps the run's checkpoint, saved in the same transaction as the run's edits so one is never kept without the other.
+class Outbox(object):
+
+    def __init__(self, outboxFile):
+        self.outboxFile = outboxFile
+        if not os.path.exists(os.path.dirname(outboxFile)):
+            os.makedirs(os.path.dirname(outboxFile))
+
+        connection = self.connect()
+        connection.execute("CREATE TABLE IF NOT EXISTS edits (id INTEGER PRIMARY KEY AUTOINCREMENT, layerURL TEXT, operation TEXT, keyWhere TEXT, "
+                           "features TEXT, featureCount INTEGER, attempts INTEGER DEFAULT 0, nextAttemptTime REAL, createdTime REAL, lastError TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS failedEdits (id INTEGER PRIMARY KEY, layerURL TEXT, operation TEXT, keyWhere TEXT, "
+                           "features TEXT, featureCount INTEGER, attempts INTEGER, createdTime REAL, failedTime REAL, lastError TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY CHECK (id = 1), checkpoint TEXT, savedTime REAL)")
+        connection.close()
+
+    # A connection to the outbox. Transactions are started with BEGIN IMMEDIATE, so only one run can change the outbox at a time.
+    def connect(self):
+        return sqlite3.connect(self.outboxFile, timeout=60, isolation_level=None)
+
+    # Add edits to the outbox in one transaction, given a list of (layer URL, "add" or "update", key where clause, features), along with
+    # the checkpoint for the next run if there is one. An add's key where clause is made from its edit ID, so None is given for it.
+    def add(self, edits, checkpoint=None):
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for layerURL, operation, keyWhere, features in edits:
+                if operation == "add":
+                    editId = uuid.uuid4().hex
+                    features = [dict(feature, attributes=dict(feature["attributes"], EditID=editId)) for feature in features]
+                    keyWhere = "EditID = '" + editId + "'"
+                connection.execute("INSERT INTO edits (layerURL, operation, keyWhere, features, featureCount, nextAttemptTime, createdTime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (layerURL, operation, keyWhere, json.dumps(features), len(features), 0, time.time()))
+            if checkpoint is not None:
+                connection.execute("INSERT OR REPLACE INTO checkpoint (id, checkpoint, savedTime) VALUES (1, ?, ?)", (json.dumps(checkpoint), time.time()))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    # The checkpoint saved with the last edits added, or None if there isn't one
+    def loadCheckpoint(self):
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT checkpoint FROM checkpoint WHERE id = 1").fetchone()
+        finally:
+            connection.close()
+        return json.loads(row[0]) if row else None
+
+    # Take the edits that are due to be sent, oldest first, holding them for sendingTimeout seconds so no other run sends them at the same time
+    def claim(self):
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            rows = connection.execute("SELECT id, layerURL, operation, keyWhere, features, attempts FROM edits WHERE nextAttemptTime <= ? ORDER BY id", (now,)).fetchall()
+            connection.execute("UPDATE edits SET attempts = attempts + 1, nextAttemptTime = ? WHERE nextAttemptTime <= ?", (now + sendingTimeout, now))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+        return [{"id": id, "layerURL": layerURL, "operation": operation, "keyWhere": keyWhere, "features": json.loads(features), "attempts": attempts + 1}
+                for id, layerURL, operation, keyWhere, features, attempts in rows]
+
+    # Remove edits that have been sent
+    def sent(self, edits):
+        self.execute("DELETE FROM edits WHERE id = ?", [(edit["id"],) for edit in edits])
+
+    # Try edits again later, waiting longer after each failure. Edits that have had maxAttempts tries are moved to the failedEdits table
+    # instead, and are returned.
+    def failed(self, edits, error):
+        givenUp = [edit for edit in edits if edit["attempts"] >= maxAttempts]
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for edit in edits:
+                if edit["attempts"] >= maxAttempts:
+                    connection.execute("INSERT INTO failedEdits (id, layerURL, operation, keyWhere, features, featureCount, attempts, createdTime, failedTime, lastError) "
+                                       "SELECT id, layerURL, operation, keyWhere, features, featureCount, attempts, createdTime, ?, ? FROM edits WHERE id = ?",
+                                       (time.time(), error[:1000], edit["id"]))
+                    connection.execute("DELETE FROM edits WHERE id = ?", (edit["id"],))
+                else:
+                    connection.execute("UPDATE edits SET nextAttemptTime = ?, lastError = ? WHERE id = ?",
+                                       (time.time() + min(maxRetryDelay, retryDelay * (2 ** (edit["attempts"] - 1))), error[:1000], edit["id"]))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        return givenUp
+
+    # Send edits again on the next run without waiting, e.g. when the run ran out of time part way through sending them. The try still counts,
+    # so any rows the edits added are removed first.
+    def retry(self, edits):
+        self.execute("UPDATE edits SET nextAttemptTime = 0 WHERE id = ?", [(edit["id"],) for edit in edits])
+
+    # Put back edits that were taken but not tried, e.g. because the run ran out of time, so the next run sends them straight away
+    def release(self, edits):
+        self.execute("UPDATE edits SET attempts = attempts - 1, nextAttemptTime = 0 WHERE id = ?", [(edit["id"],) for edit in edits])
+
+    def execute(self, sql, parameters):
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(sql, parameters)
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    # Whether there are adds to a layer still waiting to be sent from before a given edit
+    def addsWaiting(self, layerURL, beforeId):
+        connection = self.connect()
+        try:
+            return connection.execute("SELECT COUNT(*) FROM edits WHERE layerURL = ? AND operation = 'add' AND id < ?", (layerURL, beforeId)).fetchone()[0] > 0
+        finally:
+            connection.close()
+
+    # The number of edits and features waiting to be sent, and the seconds the oldest has been waiting
+    def backlog(self):
+        connection = self.connect()
+        try:
+            count, featureCount, oldestTime = connection.execute("SELECT COUNT(*), SUM(featureCount), MIN(createdTime) FROM edits").fetchone()
+        finally:
+            connection.close()
+        return count, featureCount or 0, (time.time() - oldestTime) if oldestTime else 0
+
+
+# A function that sends the edits waiting in an outbox to the portal, for up to flushSeconds. Adds to layers of the same feature service
+# are sent together with the service's applyEdits operation, up to maxFeatures features per request, and the whole request is rolled back
+# if any of it fails. Edits that can't be sent are tried again by a later run. No request waits past the end of the flushSeconds. Returns True
+# if every edit that was due was sent, or False if some were left for a later run (the portal failed or the time ran out).
+def flushOutbox(outbox, portalSession, log, flushSeconds, useApplyEdits=True, maxFeatures=2000):
+
+    deadline = time.time() + flushSeconds
+    edits = outbox.claim()
+    editsSent = 0
+    requestsMade = 0
+
+    # Group the adds into requests - consecutive adds to the same feature service, up to the maximum number of features. Updates are sent on their own.
+    requests = []
+    for edit in edits:
+        serviceURL, _, layerId = edit["layerURL"].rstrip("/").rpartition("/")
+        if edit["operation"] == "add" and useApplyEdits and layerId.isdigit():
+            lastRequest = requests[-1] if requests else None
+            if (lastRequest and lastRequest["serviceURL"] == serviceURL and
+                    lastRequest["featureCount"] + len(edit["features"]) <= maxFeatures):
+                lastRequest["edits"].append(edit)
+                lastRequest["featureCount"] += len(edit["features"])
+                continue
+            requests.append({"serviceURL": serviceURL, "edits": [edit], "featureCount": len(edit["features"])})
+        else:
+            requests.append({"serviceURL": None, "edits": [edit], "featureCount": len(edit["features"])})
+
+    # Each request waits no longer than the time left
+    portalSession.deadline = deadline
+    try:
+        for i, request in enumerate(requests):
+            if time.time() >= deadline:
+                outbox.release([edit for laterRequest in requests[i:] for edit in laterRequest["edits"]])
+                log("Ran out of time sending the outbox, the rest will be sent next run")
+                break
+
+            try:
+                # An add that has been tried before may have been added without the response getting back, so remove what it added first
+                for edit in request["edits"]:
+                    if edit["operation"] == "add" and edit["attempts"] > 1:
+                        requestsMade += 1
+                        removeRows(edit, portalSession)
+
+                if request["serviceURL"]:
+                    requestsMade += 1
+                    if not applyEdits(request["serviceURL"], request["edits"], portalSession, maxFeatures, deadline):
+                        # Fall back to posting to each layer. The failed applyEdits will have been rolled back, so nothing is added twice.
+                        log("applyEdits failed for " + request["serviceURL"] + ", posting to each layer instead")
+                        for edit in request["edits"]:
+                            checkDeadline(deadline)
+                            requestsMade += 1
+                            addFeatures(edit, portalSession)
+                elif request["edits"][0]["operation"] == "add":
+                    requestsMade += 1
+                    addFeatures(request["edits"][0], portalSession)
+                else:
+                    requestsMade += 2
+                    updateFeatures(outbox, request["edits"][0], portalSession, log)
+
+                outbox.sent(request["edits"])
+                editsSent += len(request["edits"])
+            except Exception as e:
+                if isinstance(e, OutOfTime) or time.time() >= deadline:
+                    # Some of the request may have been sent before the time ran out, so the edits are sent again next run with their rows removed first
+                    outbox.retry(request["edits"])
+                    outbox.release([edit for laterRequest in requests[i + 1:] for edit in laterRequest["edits"]])
+                    log("Ran out of time part way through sending " + str(request["featureCount"]) + " features to " + (request["serviceURL"] or request["edits"][0]["layerURL"]) +
+                        ", these and the rest will be sent next run")
+                    break
+                log("Could not send " + str(request["featureCount"]) + " features to " + (request["serviceURL"] or request["edits"][0]["layerURL"]) + ", will try again: " + str(e))
+                for edit in outbox.failed(request["edits"], str(e)):
+                    log("Gave up sending " + edit["operation"] + " of " + str(len(edit["features"])) + " features to " + edit["layerURL"] + " after " + str(edit["attempts"]) +
+                        " tries, it has been moved to the failedEdits table in " + outbox.outboxFile)
+    finally:
+        portalSession.deadline = None
+
+    count, featureCount, oldestSeconds = outbox.backlog()
+    log("Outbox: sent " + str(editsSent) + " of " + str(len(edits)) + " edits in " + str(requestsMade) + " requests, " + str(count) + " edits (" +
+        str(featureCount) + " features) waiting" + ((", oldest " + str(int(oldestSeconds / 60)) + " minutes") if count else ""))
+    return editsSent == len(edits)
+
+
+# Raised when flushing the outbox runs out of time part way through sending a request's edits
+class OutOfTime(Exception):
+    pass
+
+
+# A function that raises OutOfTime if the time for flushing the outbox is up
+def checkDeadline(deadline):
+
+    if time.time() >= deadline:
+        raise OutOfTime()
+
+
+# A function that posts a request to the portal and returns the JSON response, raising an error if the portal returns one
+def postEdits(url, data, portalSession):
+
+    r = portalSession.post(url, data)
+    if r.status_code != 200:
+        raise Exception("HTTP " + str(r.status_code) + " from " + url)
+    result = r.json()
+    if isinstance(result, dict) and "error" in result:
+        raise Exception("Error returned by " + url + " " + r.text)
+    return result
+
+
+# A function that adds features to several layers of a feature service with applyEdits, in requests of no more than maxFeatures features.
+# Each request is rolled back if any of it fails. Returns False if the service returned an error for the first request, so nothing was added,
+# and raises an error if a later request failed or a request did not get a response (e.g. timed out), as some of the features were added.
+# Raises OutOfTime if the deadline passes before a later request is sent.
+def applyEdits(serviceURL, edits, portalSession, maxFeatures, deadline=None):
+
+    # Split the edits into requests of no more than the maximum number of features
+    editRequests = [[]]
+    editRequestSize = 0
+    for edit in edits:
+        layerId = int(edit["layerURL"].rstrip("/").rpartition("/")[2])
+        i = 0
+        while i < len(edit["features"]):
+            if editRequestSize >= maxFeatures:
+                editRequests.append([])
+                editRequestSize = 0
+            chunk = edit["features"][i:i + maxFeatures - editRequestSize]
+            editRequests[-1].append({"id": layerId, "adds": chunk})
+            editRequestSize += len(chunk)
+            i += len(chunk)
+
+    for i, layerAdds in enumerate(editRequests):
+        if i > 0 and deadline is not None:
+            checkDeadline(deadline)
+
+        # Set up the data to post. If any feature can't be added, the whole request is rolled back.
+        data = {
+            "f": "json",
+            "rollbackOnFailure": "true",
+            "edits": json.dumps(layerAdds)
+        }
+
+        # Post data
+        r = portalSession.post(serviceURL + '/applyEdits', data)
+        try:
+            result = r.json()
+        except ValueError:
+            result = None
+
+        if r.status_code != 200 or not isinstance(result, list) or not all(addResult.get("success") for layerResult in result for addResult in layerResult.get("addResults", [])):
+            if i == 0:
+                return False
+            raise Exception("Error returned by applyEdits " + r.text)
+    return True
+
+
+# A function that adds an edit's features to its layer with the layer's addFeatures operation
+def addFeatures(edit, portalSession):
+
+    # Set up the data to post. If any feature can't be added, none are.
+    data = {
+        "f": "json",
+        "rollbackOnFailure": "true",
+        "features": json.dumps(edit["features"])
+    }
+
+    # Post data
+    result = postEdits(edit["layerURL"] + '/addFeatures', data, portalSession)
+    if not all(addResult.get("success") for addResult in result.get("addResults", [])):
+        raise Exception("Features not added to " + edit["layerURL"] + " " + json.dumps(result))
+
+
+# A function that removes the rows an add added (those with its edit ID), before it is sent again
+def removeRows(edit, portalSession):
+
+    # Set up the data to post
+    data = {
+        "f": "json",
+        "where": edit["keyWhere"]
+    }
+
+    # Post data
+    postEdits(edit["layerURL"] + '/deleteFeatures', data, portalSession)
+
+
+# A function that sets an update's attributes on the rows matching its key where clause. If there are no matching rows and no adds to the
+# layer are waiting to be sent before it, the row was never added (or has been removed), so there is nothing to update.
+def updateFeatures(outbox, edit, portalSession, log):
+
+    # Set up the data to post
+    data = {
+        "f": "json",
+        "where": edit["keyWhere"],
+        "returnIdsOnly": "true"
+    }
+
+    # Post data
+    objectIds = postEdits(edit["layerURL"] + '/query', data, portalSession).get("objectIds") or []
+    if not objectIds:
+        if outbox.addsWaiting(edit["layerURL"], edit["id"]):
+            raise Exception("The rows to update have not been added yet")
+        log("No rows in " + edit["layerURL"] + " where " + edit["keyWhere"] + " to update")
+        return
+
+    # Set up the data to post
+    data = {
+        "f": "json",
+        "features": json.dumps([{"attributes": dict(attributes, OBJECTID=objectId)} for objectId in objectIds for attributes in edit["features"]])
+    }
+
+    # Post data
+    result = postEdits(edit["layerURL"] + '/updateFeatures', data, portalSession)
+    if not all(updateResult.get("success") for updateResult in result.get("updateResults", [])):
+        raise Exception("Features not updated in " + edit["layerURL"] + " " + json.dumps(result))
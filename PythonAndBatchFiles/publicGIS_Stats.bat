@@ -6,8 +6,8 @@ REM
 REM Here is a list detailing what each of the parameters are:
 REM    Log filename
 REM    Short time period (e.g. 5 minutes)
-REM    Mid time period - currently unused
-REM    Long time period - currently unused
+REM    Mid time period (e.g. 30 minutes)
+REM    Long time period (e.g. 720 minutes)
 REM    A ArcGIS Server admin username
 REM    B ArcGIS Server admin password
 REM    C ArcGIS Server hostname (e.g. svr-gisapp.yourdomain.com)
@@ -21,7 +21,10 @@ REM    URL for Feature Class containing Warnings
 REM    URL for Feature Class containing Services Requested
 REM    URL for Feature Class containing Layers Drawn
 REM    URL for Feature Class containing Average Layer Draw Time
-REM    URL for Feature Class containing Services Requested by User - currently unused
+REM    URL for Feature Class containing Services Requested by User
+REM    Optional - URL for Feature Class containing Daily Totals
+REM    Optional - URL for Feature Class containing Top Services
+REM    Optional - URL for Feature Class containing Top Layers
 C:\Python27\ArcGIS10.7\python "C:\Scripts\ArcGIS_Stats\generate_stats.py" ^
     "publicGIS_Stats.log" ^
     "5" ^
@@ -41,3 +44,6 @@ C:\Python27\ArcGIS10.7\python "C:\Scripts\ArcGIS_Stats\generate_stats.py" ^
     "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/4" ^
     "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/5" ^
     "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/6" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/13" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/14" ^
+    "https://ppintgis.yourdomain.com/arcgisadm/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/15" ^
@@ -17,6 +17,8 @@ REM    F ArcGIS Portal password
 REM    G ArcGIS generate token URL (e.g. https://ppintgis.yourdomain.com/arcgis/sharing/rest/generateToken)
 REM    URL for Feature Class containing Services Status
 REM    URL for Feature Class containing Services Down
+REM    Optional - URL for Feature Class containing Latest Services Status
+REM    Optional - URL for Feature Class containing Service Changes
 "C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" "C:\Scripts\ArcGIS_Stats\generate_stats_2.py" ^
     "publicGIS_Stats_2.log" ^
     "https://publicgis.yourdomain.com/arcgis_server" ^
@@ -31,3 +33,5 @@ REM    URL for Feature Class containing Services Down
     "https://ppintgis.yourdomain.com/arcgis/sharing/rest/generateToken" ^
     "https://ppintgis.yourdomain.com/arcgis_server/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/7" ^
     "https://ppintgis.yourdomain.com/arcgis_server/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/8" ^
+    "https://ppintgis.yourdomain.com/arcgis_server/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/16" ^
+    "https://ppintgis.yourdomain.com/arcgis_server/rest/services/Stats/ArcGISStatsPublicGIS/FeatureServer/17" ^
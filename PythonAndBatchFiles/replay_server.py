@@ -0,0 +1,367 @@
+#-------------------------------------------------------------
+# Name:       ArcGIS Stats replay server
+# Purpose:    Local stand-in for the ArcGIS Server admin API and the stats feature service, so the stats scripts can be run and
+#             benchmarked without touching production. Serves recorded or synthetic log messages.
+# Author:     Keith Miller (keith.miller@kapiticoast.govt.nz)
+# Date Created:    18/10/2026
+# Copyright:   (c) Kapiti Coast District Council, Eagle Technologies
+# ArcGIS Version:   10.0+
+# Python Version:   2.7 / 3.6+
+#--------------------------------
+
+# Import modules
+import os
+import re
+import sys
+import json
+import time
+import threading
+from calendar import timegm
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+
+# Set global variables
+
+# Synthetic logs
+syntheticServices = 200 # Number of map services the synthetic log messages are spread over
+syntheticUsers = 500 # Number of distinct users making requests in the synthetic log messages
+syntheticTimePeriod = 5 # Minutes of logs the synthetic log messages are spread over
+syntheticFolders = ["", "Public", "Internal"] # Folders the synthetic services are in, for the admin services list and status endpoints
+syntheticStoppedServices = 50 # Every this many services is stopped, as if it had gone down
+
+
+# A set of synthetic log messages. Messages are generated from their position when requested rather than held in memory,
+# so millions of messages can be served. Messages are numbered from the most recent, as the logs/query operation returns them.
+class SyntheticLogs(object):
+
+    def __init__(self, noOfMessages, newestTimeUTC, timePeriod=syntheticTimePeriod):
+        self.noOfMessages = noOfMessages
+        self.newestTimeUTC = newestTimeUTC
+        self.timePeriodMs = timePeriod * 60 * 1000
+        self.oldestTimeUTC = self.messageTime(noOfMessages - 1)
+
+    def __len__(self):
+        return self.noOfMessages
+
+    # Time of the nth most recent message, in milliseconds
+    def messageTime(self, i):
+        return self.newestTimeUTC - (i * self.timePeriodMs) // max(self.noOfMessages, 1)
+
+    # Build the nth most recent message. The mix is roughly what a busy site logs at FINE level.
+    def message(self, i):
+        service = "Public/Service" + str(i % syntheticServices) + ".MapServer"
+        user = "" if i % 3 else "user" + str(i % syntheticUsers)
+        item = {"time": self.messageTime(i), "machine": "GISSERVER1", "process": "1234", "thread": str(i % 16), "user": user, "elapsed": ""}
+        kind = i % 200
+        if kind < 20:
+            item.update({"type": "FINE", "code": 9029, "source": "Rest", "message": "Request user: " + (user or "Anonymous user") + ", Service: " + service})
+        elif kind < 30:
+            item.update({"type": "FINE", "code": 100004, "source": service, "message": "End ExportMapImage", "elapsed": "%.3f" % (0.05 + (i % 97) / 40.0)})
+        elif kind == 30:
+            item.update({"type": "SEVERE", "code": 8259, "source": service, "message": "Error exporting map. Extent: " + str(1770000 + i % 5000) + ", " + str(5460000 + i % 3000)})
+        elif kind < 33:
+            item.update({"type": "WARNING", "code": 7226, "source": service, "message": "Service " + service + " took " + str(i % 60) + " seconds to respond."})
+        else:
+            item.update({"type": "FINE", "code": 100001, "source": service, "message": "Begin ExportMapImage"})
+        return item
+
+
+# A set of recorded log messages, loaded from a saved logs/query response (or a list of log messages). Times are moved forward
+# so that the most recent message is at the given time, so a recording can be replayed as if it had just been logged.
+class RecordedLogs(object):
+
+    def __init__(self, captureFile, newestTimeUTC):
+        with open(captureFile, "r") as f:
+            capture = json.load(f)
+        if isinstance(capture, dict):
+            capture = capture["logMessages"]
+
+        self.messages = sorted(capture, key=lambda k: k["time"], reverse=True)
+        if self.messages:
+            shift = newestTimeUTC - self.messages[0]["time"]
+            for item in self.messages:
+                item["time"] += shift
+            self.oldestTimeUTC = self.messages[-1]["time"]
+        else:
+            self.oldestTimeUTC = newestTimeUTC
+        self.newestTimeUTC = newestTimeUTC
+
+    def __len__(self):
+        return len(self.messages)
+
+    def messageTime(self, i):
+        return self.messages[i]["time"]
+
+    def message(self, i):
+        return self.messages[i]
+
+
+# A function that finds the position of the first message at or before a time. Messages are in order, most recent first.
+def firstMessageAtOrBefore(logs, timeUTC):
+
+    low = 0
+    high = len(logs)
+    while low < high:
+        middle = (low + high) // 2
+        if logs.messageTime(middle) > timeUTC:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# A function that converts a "2020-01-10 10:00:00" date to epoch milliseconds
+def sqlTimestamp(value):
+
+    return timegm(time.strptime(value, "%Y-%m-%d %H:%M:%S")) * 1000
+
+
+# A function that checks whether a feature's attributes match a where clause. Only handles the clauses the stats scripts use -
+# comparisons of a field to a number, 'text' or timestamp 'yyyy-mm-dd hh:mm:ss', and field IS NULL, joined with AND.
+def matchesWhereClause(attributes, whereClause):
+
+    for condition in re.split(r"\s+AND\s+", whereClause or "1=1", flags=re.IGNORECASE):
+        isNull = re.match(r"\s*(\w+)\s+IS\s+NULL\s*$", condition, flags=re.IGNORECASE)
+        if isNull:
+            if attributes.get(isNull.group(1)) is not None:
+                return False
+            continue
+        field, operator, value = re.match(r"\s*(\w+)\s*(<=|>=|<>|<|>|=)\s*(.*?)\s*$", condition).groups()
+        if field not in attributes:
+            continue
+        if value.lower().startswith("timestamp"):
+            value = sqlTimestamp(value.split("'")[1])
+        elif value.startswith("'"):
+            value = value.strip("'")
+        else:
+            value = float(value)
+        actual = attributes[field]
+        if actual is None or not {"<=": actual <= value, ">=": actual >= value, "<>": actual != value, "<": actual < value, ">": actual > value, "=": actual == value}[operator]:
+            return False
+    return True
+
+
+# Handles requests to the stand-in endpoints
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1" # Keep connections alive, as ArcGIS Server and Portal do
+    disable_nagle_algorithm = True # The headers and body are written separately, which would otherwise wait on the client's delayed ACK for each request
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not isinstance(body, str):
+            body = body.decode("utf-8")
+        params = dict((key, values[0]) for key, values in parse_qs(body).items())
+        self.server.countRequest(path, len(body))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if path.endswith("/admin/generateToken") or path.endswith("/sharing/rest/generateToken"):
+            result = {"token": "replay-token", "expires": int(time.time() * 1000) + (60 * 60 * 1000)}
+        elif path.endswith("/admin/logs/query"):
+            result = self.queryLogs(params)
+        elif "/admin/services" in path:
+            result = self.serviceCatalog(path)
+        elif path.endswith("/applyEdits"):
+            result = []
+            for layerEdits in json.loads(params.get("edits", "[]")):
+                layerPath = path.rsplit("/", 1)[0] + "/" + str(layerEdits["id"]) + "/applyEdits"
+                result.append({"id": layerEdits["id"],
+                               "addResults": self.server.addFeatures(layerPath, layerEdits.get("adds") or []),
+                               "updateResults": self.server.updateFeatures(layerPath, layerEdits.get("updates") or []),
+                               "deleteResults": [{"objectId": objectId, "success": True} for objectId in self.server.deleteFeatures(layerPath, layerEdits.get("deletes") or [])]})
+        elif path.endswith("/addFeatures"):
+            result = {"addResults": self.server.addFeatures(path, json.loads(params.get("features", "[]")))}
+        elif path.endswith("/updateFeatures"):
+            result = {"updateResults": self.server.updateFeatures(path, json.loads(params.get("features", "[]")))}
+        elif path.endswith("/query"):
+            objectIds = [int(objectId) for objectId in params["objectIds"].split(",")] if params.get("objectIds") else None
+            features = self.server.queryFeatures(path, params.get("where"), objectIds)
+            if params.get("returnCountOnly") == "true":
+                result = {"count": len(features)}
+            elif params.get("returnIdsOnly") == "true":
+                result = {"objectIdFieldName": "OBJECTID", "objectIds": [feature["OBJECTID"] for feature in features]}
+            else:
+                outFields = params.get("outFields", "*")
+                result = {"objectIdFieldName": "OBJECTID", "features": [{"attributes": feature if outFields == "*" else dict((field, feature.get(field)) for field in outFields.split(","))} for feature in features]}
+        elif path.endswith("/deleteFeatures"):
+            objectIds = [int(objectId) for objectId in params["objectIds"].split(",")] if params.get("objectIds") else None
+            result = {"deleteResults": [{"objectId": objectId, "success": True} for objectId in self.server.deleteFeatures(path, objectIds, params.get("where"))]}
+        else:
+            result = {"status": "error", "messages": ["Not found: " + path], "code": 404}
+
+        self.sendJson(result)
+
+    # Return a page of log messages between startTime (most recent) and endTime (oldest), most recent first
+    def queryLogs(self, params):
+        logs = self.server.logs
+        startTime = int(params.get("startTime", logs.newestTimeUTC))
+        endTime = int(params.get("endTime", logs.oldestTimeUTC))
+        pageSize = int(params.get("pageSize", 1000))
+
+        first = firstMessageAtOrBefore(logs, startTime)
+        last = firstMessageAtOrBefore(logs, endTime - 1) # First message after the time period
+        pageEnd = min(first + pageSize, last)
+
+        return {
+            "hasMore": pageEnd < last,
+            "startTime": startTime,
+            "endTime": endTime,
+            "logMessages": [logs.message(i) for i in range(first, pageEnd)]
+            }
+
+    # Return the folders and services in a folder, or the status of a service, for the synthetic services
+    def serviceCatalog(self, path):
+        parts = path.split("/admin/services")[1].strip("/").split("/")
+        if parts[-1] == "status":
+            serviceNumber = int(parts[-2].split(".")[0].replace("Service", ""))
+            if serviceNumber >= syntheticServices:
+                return {"status": "error", "messages": ["Service '" + parts[-2] + "' does not exist."], "code": 404}
+            state = "STOPPED" if serviceNumber % syntheticStoppedServices == 0 else "STARTED"
+            return {"configuredState": "STARTED", "realTimeState": state}
+
+        folder = parts[0] if parts[0] in syntheticFolders else ""
+        folderIndex = syntheticFolders.index(folder)
+        services = [{"folderName": folder or "/", "serviceName": "Service" + str(i), "type": "MapServer"}
+                    for i in range(syntheticServices) if i % len(syntheticFolders) == folderIndex]
+        return {"folderName": folder or "/", "folders": [name for name in syntheticFolders if name] if not folder else [], "services": services}
+
+    def sendJson(self, result):
+        data = json.dumps(result, separators=(",", ":")).encode("utf-8") # Compact, as ArcGIS Server returns it
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The stand-in server. Keeps a count of the requests made to each endpoint and the features written to each layer.
+class ReplayServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, logs, port=0, latency=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), ReplayRequestHandler)
+        self.logs = logs
+        self.latency = latency # Seconds each request takes to answer, to stand in for a server across the network
+        self.lock = threading.Lock()
+        self.resetCounts()
+
+    def resetCounts(self):
+        with self.lock:
+            self.requestCounts = {}
+            self.firstRequestTime = None
+            self.bytesReceived = 0
+            self.featuresAdded = {}
+            self.layerFeatures = {} # Attributes of the features in each layer, by object id
+            self.nextObjectId = 1
+
+    def countRequest(self, path, size):
+        endpoint = "/".join(path.split("/")[-2:])
+        with self.lock:
+            if self.firstRequestTime is None:
+                self.firstRequestTime = time.time()
+            self.requestCounts[endpoint] = self.requestCounts.get(endpoint, 0) + 1
+            self.bytesReceived += size
+
+    def addFeatures(self, path, features):
+        with self.lock:
+            self.featuresAdded[path] = self.featuresAdded.get(path, 0) + len(features)
+            return [{"objectId": self.storeFeature(path.rsplit("/", 1)[0], feature["attributes"]), "success": True} for feature in features]
+
+    # Keep a feature's attributes in a layer, with any dates as epoch milliseconds as the feature service stores them. Returns its object id.
+    def storeFeature(self, layerPath, attributes, objectId=None):
+        attributes = dict(attributes)
+        for field, value in attributes.items():
+            if field.endswith("UTC") and value is not None and not isinstance(value, (int, float)):
+                attributes[field] = sqlTimestamp(value.rstrip(" APM"))
+        if objectId is None:
+            objectId = self.nextObjectId
+            self.nextObjectId += 1
+        attributes["OBJECTID"] = objectId
+        self.layerFeatures.setdefault(layerPath, {})[objectId] = attributes
+        return objectId
+
+    # Update the attributes of features already in a layer, by their object ids
+    def updateFeatures(self, path, features):
+        with self.lock:
+            layerFeatures = self.layerFeatures.get(path.rsplit("/", 1)[0], {})
+            results = []
+            for feature in features:
+                objectId = feature["attributes"].get("OBJECTID")
+                if objectId in layerFeatures:
+                    objectId = self.storeFeature(path.rsplit("/", 1)[0], dict(layerFeatures[objectId], **feature["attributes"]), objectId)
+                results.append({"objectId": objectId, "success": objectId in layerFeatures})
+            return results
+
+    # Give a layer a number of features old enough to be purged, e.g. addOldFeatures("/arcgis/rest/services/Stats/FeatureServer/0", 10000),
+    # or features with the given attributes, e.g. addOldFeatures(layerPath, [{"StatDateUTC": 0, "Service": "Basemap"}])
+    def addOldFeatures(self, layerPath, features):
+        with self.lock:
+            for attributes in (features if isinstance(features, list) else [{"StatDateUTC": 0}] * features):
+                self.storeFeature(layerPath, attributes)
+
+    # The features in a layer matching a where clause and object ids
+    def queryFeatures(self, path, whereClause=None, objectIds=None):
+        with self.lock:
+            layerFeatures = self.layerFeatures.get(path.rsplit("/", 1)[0], {})
+            return [dict(layerFeatures[objectId]) for objectId in (objectIds if objectIds is not None else sorted(layerFeatures))
+                    if objectId in layerFeatures and matchesWhereClause(layerFeatures[objectId], whereClause)]
+
+    # Delete the given features from a layer, or those matching a where clause, or all of them, and return the ids deleted
+    def deleteFeatures(self, path, objectIds=None, whereClause=None):
+        with self.lock:
+            layerFeatures = self.layerFeatures.get(path.rsplit("/", 1)[0], {})
+            deleted = [objectId for objectId in (objectIds if objectIds is not None else sorted(layerFeatures))
+                       if objectId in layerFeatures and matchesWhereClause(layerFeatures[objectId], whereClause)]
+            for objectId in deleted:
+                del layerFeatures[objectId]
+            return deleted
+
+    def baseURL(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    # Start serving on a background thread
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+# A function that returns the current UTC time rounded down to the minute, in milliseconds - the most recent time the stats scripts fetch logs up to.
+def currentMinuteUTC():
+
+    return (timegm(time.gmtime()) // 60) * 60 * 1000
+
+
+# This test allows the script to be run from the command prompt to serve synthetic or recorded logs:
+#   python replay_server.py <port> <number of synthetic messages | recorded logs/query JSON file> [seconds each request takes]
+if __name__ == '__main__':
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6080
+    source = sys.argv[2] if len(sys.argv) > 2 else "10000"
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    if os.path.exists(source):
+        logs = RecordedLogs(source, currentMinuteUTC())
+    else:
+        logs = SyntheticLogs(int(source), currentMinuteUTC())
+
+    server = ReplayServer(logs, port, latency)
+    print("Serving " + str(len(logs)) + " log messages on " + server.baseURL())
+    server.serve_forever()
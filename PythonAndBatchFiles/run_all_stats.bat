@@ -0,0 +1,12 @@
+REM ----- ArcGIS Stats extract for all sites -----
+REM
+REM Runs generate_stats.py and generate_stats_2.py for every site in run_all_stats.json at the same time, instead of running
+REM intGIS_Stats.bat, intGIS_Stats_2.bat, publicGIS_Stats.bat and publicGIS_Stats_2.bat separately.
+REM
+REM You will need to amend run_all_stats.json so that it reflects your environment - server details, usernames and passwords,
+REM and the feature class URLs, as in the other batch files. This needs the Python 3.6 exe, as generate_stats_2.py does.
+REM
+REM Here is a list detailing what each of the parameters are:
+REM    Config file (optional, defaults to run_all_stats.json in the same folder as the script)
+"C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" "C:\Scripts\ArcGIS_Stats\run_all_stats.py" ^
+    "C:\Scripts\ArcGIS_Stats\run_all_stats.json"
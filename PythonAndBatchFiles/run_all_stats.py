@@ -0,0 +1,146 @@
+#-------------------------------------------------------------
+# Name:       ArcGIS Stats - Run all sites
+# Purpose:    Runs the log extraction (generate_stats.py) and service status checks (generate_stats_2.py) for every ArcGIS Server
+#             site listed in a config file at the same time, in one process, instead of one batch file per site and script.
+#             Portal sessions and tokens are shared between the sites, and the time each stage took is reported for each site.
+# Author:     Keith Miller (keith.miller@kapiticoast.govt.nz)
+# Date Created:    18/10/2026
+# Copyright:   (c) Kapiti Coast District Council, Eagle Technologies
+# ArcGIS Version:   10.0+
+# Python Version:   3.6+
+#--------------------------------
+
+# Import modules
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import generate_stats
+import generate_stats_2
+
+# Set global variables
+# Logging
+loggingEnabled = True # Use within code - logger.info("Example..."), logger.warning("Example..."), logger.error("Example...")
+logFilename = "run_all_stats.log" # Log file for all sites, in the Logs folder. Each line has the site and script it came from.
+maxWorkers = 8 # Most sites and scripts run at the same time, if not set in the config file
+
+# Scripts that can be run for each site - the key in the site's config, and the module whose mainFunction is called with it
+siteTasks = [("generateStats", generate_stats), ("serviceStatus", generate_stats_2)]
+
+
+# A function that reads the config file. Settings in "portal" apply to every site and script unless the site sets them itself.
+def loadConfig(configFile):
+
+    with open(configFile, "r") as f:
+        config = json.load(f)
+
+    portal = config.get("portal", {})
+    for site in config["sites"]:
+        for taskName, module in siteTasks:
+            if taskName in site:
+                for key, value in portal.items():
+                    site[taskName].setdefault(key, value)
+    return config
+
+
+# A function that runs one of the scripts for a site, and returns the time each of its stages took
+def runSiteTask(siteName, taskName, module, parameters):
+
+    threading.current_thread().name = siteName + "/" + taskName
+    startTime = time.time()
+    module.log("***************")
+    module.log("Process started")
+    module.mainFunction(**parameters)
+    return module.stageTimings.get(parameters["logFilename"], []) + [("Total", time.time() - startTime)]
+
+
+# Start of main function
+def mainFunction(configFile):
+
+    logger = logging.getLogger("run_all_stats")
+    config = loadConfig(configFile)
+
+    # Both scripts share one set of sessions and tokens, so a portal login made for one site is reused by the others
+    generate_stats_2.warmSessions = generate_stats.warmSessions
+    generate_stats_2.warmSessionsLock = generate_stats.warmSessionsLock
+    for taskName, module in siteTasks:
+        module.keepSessions = "true"
+
+        # Log to the log file for all sites. Each script closes and removes its log handler at the end of a run, so it is given one that is not used.
+        module.logger = logger
+        module.logMessage = logging.FileHandler(os.devnull, delay=True)
+
+    startTime = time.time()
+    executor = ThreadPoolExecutor(max_workers=config.get("maxWorkers", maxWorkers))
+    futures = []
+    for site in config["sites"]:
+        for taskName, module in siteTasks:
+            if taskName in site:
+                futures.append((site["name"], taskName, executor.submit(runSiteTask, site["name"], taskName, module, site[taskName])))
+
+    # Report the time each stage took for each site
+    for siteName, taskName, future in futures:
+        try:
+            stageTimings = future.result()
+            logger.info("Stage timings for " + siteName + "/" + taskName + ": " + ", ".join(stage + ": " + ("%.2f" % seconds) + "s" for stage, seconds in stageTimings))
+        except (Exception, SystemExit) as e:
+            logger.error(siteName + "/" + taskName + " failed: " + str(e))
+    executor.shutdown()
+
+    # Close the connections kept open between the sites
+    for session in generate_stats.warmSessions.values():
+        if isinstance(session, generate_stats.AdminConnectionPool):
+            session.close()
+
+    logger.info("All sites finished in " + ("%.2f" % (time.time() - startTime)) + "s")
+    logger.info("Process ended")
+
+# End of main function
+
+
+# Start of set logging function
+def setLogging(logFile):
+
+    # Create a logger
+    logger = logging.getLogger("run_all_stats")
+    logger.setLevel(logging.DEBUG)
+
+    # Setup log message handler
+    logMessage = logging.FileHandler(logFile)
+
+    # Setup the log formatting. Each site runs on a thread named after it.
+    logFormat = logging.Formatter("%(asctime)s: %(levelname)s - %(threadName)s - %(message)s", "%d/%m/%Y - %H:%M:%S")
+
+    # Add formatter to log message handler
+    logMessage.setFormatter(logFormat)
+
+    # Add log message handler to logger
+    logger.addHandler(logMessage)
+
+    return logger, logMessage
+
+# End of set logging function
+
+
+# This test allows the script to be run from the command prompt:
+#   python run_all_stats.py [config file, defaults to run_all_stats.json next to this script]
+if __name__ == '__main__':
+
+    configFile = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_all_stats.json")
+    logFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Logs", logFilename)
+    print(logFile)
+
+    if loggingEnabled:
+        logger, logMessage = setLogging(logFile)
+        logger.info("***************")
+        logger.info("Process started")
+
+    mainFunction(configFile)
+
+    if loggingEnabled:
+        logMessage.close()
+        logger.removeHandler(logMessage)
@@ -0,0 +1,183 @@
+#-------------------------------------------------------------
+# Name:       ArcGIS Stats common
+# Purpose:    The portal session, state files, stage timings and other helpers shared by generate_stats.py, generate_stats_2.py
+#             and clean_up.py.
+# Author:     Keith Miller (keith.miller@kapiticoast.govt.nz)
+# Date Created:    18/10/2026
+# Copyright:   (c) Kapiti Coast District Council, Eagle Technologies
+# ArcGIS Version:   10.0+
+# Python Version:   2.7 / 3.6+
+#--------------------------------
+
+# Import modules
+import os
+import sys
+import copy
+import json
+import time
+import threading
+import requests
+from requests_ntlm import HttpNtlmAuth # This module is only needed when using Windows single sign on into ArcGIS Portal
+
+
+# A session used for every request to the portal in a run. The NTLM authenticated connection is kept alive and reused, rather than
+# authenticating a new connection for each request, and the portal token is generated once (and again before it expires) and added to each request.
+# Runs made at the same time (e.g. by run_all_stats.py) each use their own copy from forRun, which shares the connection and token but counts its own requests.
+class PortalSession(object):
+
+    def __init__(self, tokenURL, domainUsername, domainPassword, tokenExpiration=60, tokenRefreshMargin=5, requestTimeout=60):
+        self.tokenURL = tokenURL
+        self.tokenExpiration = tokenExpiration # Minutes the portal token is requested for
+        self.tokenRefreshMargin = tokenRefreshMargin # The token is generated again when it is this many minutes from expiring
+        self.requestTimeout = requestTimeout # Seconds to wait when connecting to or reading from the portal
+        self.deadline = None # If set (e.g. while sending the outbox), requests wait no longer than the time left until then
+        self.session = requests.Session()
+
+        # The correct authorisation method needs to be used here. I've used HttpNtlmAuth as that works with Windows single sign on to ArcGIS Portal.
+        # For more info see https://requests.readthedocs.io/en/master/user/authentication/
+        self.session.auth = HttpNtlmAuth(domainUsername, domainPassword)
+        self.session.headers.update({"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"})
+
+        self.tokenInfo = {"token": None, "expires": 0} # Shared by the copies made by forRun
+        self.tokenLock = threading.Lock() # The session can be used by several threads at once, which should not all generate a new token
+        self.countLock = threading.Lock()
+        self.resetCounts()
+
+    # A copy of the session for a run, sharing its connection and token, with its own request counts
+    def forRun(self):
+        runSession = copy.copy(self)
+        runSession.countLock = threading.Lock()
+        runSession.resetCounts()
+        return runSession
+
+    # Start counting requests again for a new run
+    def resetCounts(self):
+        with self.countLock:
+            self.requestsMade = 0
+            self.handshakes = 0
+            self.bytesSent = 0
+
+    # Generate the portal token the first time it is needed, and again when it is about to expire
+    def getToken(self):
+        with self.tokenLock:
+            if self.tokenInfo["token"] is None or tokenExpiring(self.tokenInfo["expires"], self.tokenRefreshMargin):
+                r = self.post(self.tokenURL, {"f": "json", "expiration": self.tokenExpiration}, addToken=False)
+                tokenInfo = r.json()
+                self.tokenInfo["token"] = tokenInfo['token']
+                self.tokenInfo["expires"] = tokenExpiryTime(tokenInfo, self.tokenExpiration)
+            return self.tokenInfo["token"]
+
+    # Post data to a URL, adding the portal token
+    def post(self, url, data, addToken=True):
+        if addToken:
+            r = self.session.post(url, data=dict(data, token=self.getToken()), timeout=self.timeout())
+
+            # The portal has rejected the token before it expired (e.g. after a restart), so generate a new one and try again
+            if invalidToken(r):
+                self.countRequest(r)
+                self.tokenInfo["token"] = None
+                r = self.session.post(url, data=dict(data, token=self.getToken()), timeout=self.timeout())
+        else:
+            r = self.session.post(url, data=data, timeout=self.timeout())
+        self.countRequest(r)
+        return r
+
+    # Seconds to wait for a request - the request timeout, or the time left until the deadline if that is sooner
+    def timeout(self):
+        if self.deadline is None:
+            return self.requestTimeout
+        return max(min(self.requestTimeout, self.deadline - time.time()), 1)
+
+    # Count a request, and the NTLM handshake and bytes sent for it
+    def countRequest(self, r):
+        # Any earlier responses are the NTLM challenges, which only happen when the connection has to be authenticated
+        with self.countLock:
+            self.requestsMade += 1
+            if r.history:
+                self.handshakes += 1
+            for response in r.history + [r]:
+                self.bytesSent += len(response.request.body or "") + sum(len(k) + len(v) + 4 for k, v in response.request.headers.items())
+
+    # Summary of the requests made in this run
+    def summary(self):
+        return "Portal requests: " + str(self.requestsMade) + ", NTLM handshakes: " + str(self.handshakes) + ", bytes sent: " + str(self.bytesSent)
+
+
+# A function that returns when a generated token expires, in milliseconds, from the token response. The expiry can come back as a string,
+# so it is converted to a number. If it isn't returned, the token is taken to expire after the number of minutes it was requested for.
+def tokenExpiryTime(tokenInfo, tokenExpiration):
+
+    if tokenInfo.get('expires'):
+        return int(float(tokenInfo['expires']))
+    return int((time.time() + (tokenExpiration * 60)) * 1000)
+
+
+# A function that checks whether a token expiry time (in milliseconds) is within a number of minutes of expiring
+def tokenExpiring(tokenExpires, tokenRefreshMargin):
+
+    return tokenExpires - (tokenRefreshMargin * 60 * 1000) <= time.time() * 1000
+
+
+# A function that checks whether a response is an invalid or expired token error
+def invalidToken(r):
+
+    try:
+        error = r.json().get("error")
+    except (ValueError, AttributeError):
+        return False
+    return isinstance(error, dict) and error.get("code") in (498, 499)
+
+
+# A function that records how long a stage of a run took in the run's list of stage timings, and returns the time the next stage starts
+def recordStage(stageTimings, stage, stageStartTime):
+
+    stageEndTime = time.time()
+    stageTimings.append((stage, stageEndTime - stageStartTime))
+    return stageEndTime
+
+
+# A function that returns a run's stage timings as text, e.g. "Fetch logs: 1.23s, Publish: 0.45s"
+def stageTimingsSummary(stageTimings):
+
+    return ", ".join(stage + ": " + ("%.2f" % seconds) + "s" for stage, seconds in stageTimings)
+
+
+# A function that loads the state saved by the previous run, or an empty state if there isn't one.
+def loadState(stateFile):
+
+    if not os.path.exists(stateFile):
+        return {}
+
+    with open(stateFile, "r") as f:
+        return json.load(f)
+
+
+# A function that saves the state for the next run. The file is written in full before it replaces the old one, so a failed run can't leave it half written.
+def saveState(stateFile, state):
+
+    if not os.path.exists(os.path.dirname(stateFile)):
+        os.makedirs(os.path.dirname(stateFile))
+
+    tempFile = stateFile + ".tmp"
+    with open(tempFile, "w") as f:
+        json.dump(state, f)
+
+    if os.path.exists(stateFile):
+        os.remove(stateFile)
+    os.rename(tempFile, stateFile)
+
+
+# A function that checks whether the script is running as a geoprocessing tool rather than from the command prompt. A tool is run
+# by ArcMap or ArcGIS Pro rather than python.exe, or from the Python window where arcpy has already been imported.
+def runningAsTool():
+
+    return "arcpy" in sys.modules or not os.path.basename(sys.executable).lower().startswith("python")
+
+
+# A function that imports arcpy, for when running as a geoprocessing tool, and sets a script's arcpy and ArcpyExecuteError globals to it
+def loadArcpy(scriptGlobals):
+
+    import arcpy
+    scriptGlobals["arcpy"] = arcpy
+    scriptGlobals["ArcpyExecuteError"] = arcpy.ExecuteError
+    return arcpy